@@ -0,0 +1,138 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import os
+import sys
+import json
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+import sqlite3
+
+BENCHMARK_PASSPHRASE = 'benchmark'
+
+_PRELOADED = 'MYPASS_BENCHMARK_PRELOADED'
+
+
+def get_cipher_version():
+    with sqlite3.connect(':memory:') as db:
+        row = db.execute('PRAGMA cipher_version').fetchone()
+    return row and row[0]
+
+
+def ensure_sqlcipher():
+    # Like the daemon, benchmarks using the database directly must run
+    # with SQLCipher preloaded, so they re-execute themselves if needed.
+    if get_cipher_version():
+        return
+    if os.environ.get(_PRELOADED):
+        sys.exit('SQLCipher unavailable')
+
+    from mypass.client import _find_sqlcipher
+    ld_preload = '{} {}'.format(os.environ.get('LD_PRELOAD', ''), _find_sqlcipher()).lstrip()
+    module = sys.modules['__main__'].__spec__.name
+    os.execve(sys.executable, [sys.executable, '-m', module] + sys.argv[1:],
+              dict(os.environ, LD_PRELOAD=ld_preload, **{_PRELOADED: '1'}))
+
+
+def isolate_config(home, config=None):
+    # Benchmarks run with the default settings, unless a config file is
+    # given, regardless of the config of the user running them.
+    os.environ['HOME'] = home
+    if config:
+        dirname = os.path.join(home, '.config', 'mypass')
+        os.makedirs(dirname)
+        with open(config) as src, open(os.path.join(dirname, 'config.ini'), 'w') as dst:
+            dst.write(src.read())
+
+
+def generate_records(size, rand):
+    # Records for the given number of contexts, where each website has one
+    # to three usernames, and about every tenth website has an alias.
+    records = []
+    contexts = 0
+    site = 0
+
+    while contexts < size:
+        context = 'site{}.example.com'.format(site)
+        aliases = []
+        if contexts + 1 < size and rand.random() < 0.1:
+            aliases.append('www.' + context)
+
+        for n in range(rand.randint(1, 3)):
+            password = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(16))
+            records.append((context, 'user{}@example.org'.format(n), password, aliases))
+
+        contexts += 1 + len(aliases)
+        site += 1
+
+    return records
+
+
+def get_metadata():
+    # SQLCipher must not be preloaded into other programs.
+    env = {k: v for k, v in os.environ.items() if k != 'LD_PRELOAD'}
+    try:
+        revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           env=env,
+                                           stderr=subprocess.DEVNULL,
+                                           universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    metadata = {
+        'revision': revision,
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+    # The SQLite version is only relevant if it is the one of SQLCipher,
+    # i.e. if the benchmark uses the database in the same process.
+    cipher_version = get_cipher_version()
+    if cipher_version:
+        metadata['sqlite'] = sqlite3.sqlite_version
+        metadata['sqlcipher'] = cipher_version
+    return metadata
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'runs': len(times),
+        'min': times[0],
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'p95': times[min(int(len(times) * 0.95), len(times) - 1)],
+        'p99': times[min(int(len(times) * 0.99), len(times) - 1)],
+        'max': times[-1],
+    }
+
+
+def write_results(results, output):
+    data = json.dumps(results, indent=2) + '\n'
+    if output == '-':
+        sys.stdout.write(data)
+    else:
+        with open(output, 'w') as file:
+            file.write(data)
+
+
+def print_stats(group, name, stats):
+    # The median and 95th percentile are printed to stderr
+    # (in milliseconds), in order to follow the progress.
+    print('{:>8} {:<20} {:>10.3f} ms {:>10.3f} ms (p95, {} runs)'.format(
+        group, name, stats['median'] * 1000, stats['p95'] * 1000, stats['runs']
+    ), file=sys.stderr)
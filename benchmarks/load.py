@@ -0,0 +1,253 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Spawns a daemon with a synthetic database, and runs a mix of requests
+# from concurrent client processes against its socket, e.g.:
+#
+#   python3 -m benchmarks.load --clients 1 4 16 --mix get=90,add=10
+#
+# The daemon listens at the same socket as when using mypass normally,
+# so any running daemon has to be shut down first with "mypass lock".
+
+import sys
+import time
+import random
+import argparse
+import tempfile
+import itertools
+import collections
+import multiprocessing
+
+from benchmarks.common import (BENCHMARK_PASSPHRASE, isolate_config, get_metadata,
+                               generate_records, summarize, write_results)
+from mypass import Error, ConnectionLost
+from mypass.client import Client
+
+CLIENTS = [1, 4, 16]
+MIX = 'get=80,list=2,search=5,complete=5,add=5,remove=3'
+IMPORT_CHUNK_SIZE = 1000
+
+
+def _get(state):
+    return 'get-credentials', [state.rand.choice(state.contexts)]
+
+
+def _list(state):
+    return 'get-contexts', []
+
+
+def _search(state):
+    return 'search', [state.rand.choice(state.contexts)[:6], 20]
+
+
+def _complete(state):
+    return 'complete-contexts', [state.rand.choice(state.contexts)[:6], 1000]
+
+
+def _add(state):
+    context = 'load{}-{}.example.net'.format(state.index, next(state.counter))
+    state.added.append(context)
+    return 'store-credentials', [context, 'user', 'password', True]
+
+
+def _remove(state):
+    # Only contexts added by the same client are removed, so that
+    # removing them never fails, and if there are none yet, one is added.
+    if not state.added:
+        return _add(state)
+    return 'delete-context', [state.added.pop(state.rand.randrange(len(state.added)))]
+
+
+OPERATIONS = {
+    'get': _get,
+    'list': _list,
+    'search': _search,
+    'complete': _complete,
+    'add': _add,
+    'remove': _remove,
+}
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, sep, weight = item.partition('=')
+        if name not in OPERATIONS or not sep or not weight.isdigit():
+            raise argparse.ArgumentTypeError('invalid operation mix: {!r}'.format(value))
+        mix[name] = int(weight)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError('invalid operation mix: {!r}'.format(value))
+    return mix
+
+
+def run_client(index, args, contexts, barrier, queue):
+    state = argparse.Namespace(index=index, contexts=contexts, added=[],
+                               counter=itertools.count(),
+                               rand=random.Random('{}-{}'.format(args.seed, index)))
+    names = list(args.mix)
+    weights = list(args.mix.values())
+
+    latencies = collections.defaultdict(list)
+    accepts = []
+    errors = collections.Counter()
+    client = None
+
+    barrier.wait()
+    start = time.monotonic()
+    deadline = start + args.duration
+
+    while time.monotonic() < deadline:
+        # The accept delay is the time from connecting until the response
+        # to the first request arrives, since the daemon reads the hello
+        # (and the kernel might even complete the connection) only once
+        # it gets around to accept and serve the connection.
+        if not client:
+            connect_start = time.perf_counter()
+            client = Client()
+            if client.database_locked:
+                errors['ConnectionRefused'] += 1
+                client = None
+                time.sleep(0.001)
+                continue
+            requests = 0
+
+        command, call_args = OPERATIONS[state.rand.choices(names, weights)[0]](state)
+        request_start = time.perf_counter()
+        try:
+            client.call(command, *call_args)
+        except ConnectionLost:
+            errors['ConnectionLost'] += 1
+            client.close()
+            client = None
+            continue
+        except Error as e:
+            errors[type(e).__name__] += 1
+        end = time.perf_counter()
+
+        latencies[command].append(end - request_start)
+        if requests == 0:
+            accepts.append(end - connect_start)
+
+        requests += 1
+        if requests == args.requests_per_connection:
+            client.close()
+            client = None
+
+    if client:
+        client.close()
+    queue.put((start, time.monotonic(), dict(latencies), accepts, dict(errors)))
+
+
+def run_load(clients, args, contexts):
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(clients)
+    queue = context.Queue()
+    processes = [context.Process(target=run_client, args=(index, args, contexts, barrier, queue))
+                 for index in range(clients)]
+
+    for process in processes:
+        process.start()
+    reports = [queue.get() for process in processes]
+    for process in processes:
+        process.join()
+
+    duration = max(report[1] for report in reports) - min(report[0] for report in reports)
+    latencies = collections.defaultdict(list)
+    accepts = []
+    errors = collections.Counter()
+    for start, end, client_latencies, client_accepts, client_errors in reports:
+        for command, times in client_latencies.items():
+            latencies[command] += times
+        accepts += client_accepts
+        errors.update(client_errors)
+
+    all_latencies = list(itertools.chain.from_iterable(latencies.values()))
+    return {
+        'duration': duration,
+        'requests': len(all_latencies),
+        'throughput': len(all_latencies) / duration,
+        'latency': summarize(all_latencies) if all_latencies else None,
+        'commands': {command: summarize(times) for command, times in latencies.items()},
+        'accept': summarize(accepts) if accepts else None,
+        'errors': dict(errors),
+    }
+
+
+def print_report(clients, result):
+    print('{:>4} clients {:>10.1f} req/s {:>8} errors'.format(
+        clients, result['throughput'], sum(result['errors'].values())
+    ), file=sys.stderr)
+
+    rows = [('all', result['latency']), ('accept', result['accept'])]
+    rows += sorted(result['commands'].items())
+    for name, stats in rows:
+        if stats:
+            print('     {:<20} {:>10.3f} ms {:>10.3f} ms {:>10.3f} ms (p50, p95, p99)'.format(
+                name, stats['median'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000
+            ), file=sys.stderr)
+
+
+def populate(client, size, rand):
+    records = [list(record) for record in generate_records(size, rand)]
+    import_id = client.call('begin-import')
+    for i in range(0, len(records), IMPORT_CHUNK_SIZE):
+        client.call('add-import-records', import_id, records[i:i + IMPORT_CHUNK_SIZE])
+    client.call('commit-import', import_id, 'fail', False)
+    return client.call('get-contexts')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs concurrent requests against the daemon')
+    parser.add_argument('--clients', type=int, nargs='+', default=CLIENTS,
+                        help='number of concurrent client processes of each run')
+    parser.add_argument('--mix', type=parse_mix, default=MIX,
+                        help='weights of the operations ({})'.format(', '.join(OPERATIONS)))
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds each run lasts')
+    parser.add_argument('--requests-per-connection', type=int, default=100,
+                        help='number of requests after which clients reconnect, 0 means never')
+    parser.add_argument('--size', type=int, default=10000,
+                        help='number of contexts of the database')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', help='config file with settings to use instead of the defaults')
+    parser.add_argument('--output', '-o', default='-')
+    args = parser.parse_args()
+
+    results = {
+        'benchmark': 'load',
+        'metadata': get_metadata(),
+        'parameters': vars(args),
+        'results': {},
+    }
+
+    with tempfile.TemporaryDirectory() as home:
+        isolate_config(home, args.config)
+
+        with Client() as client:
+            if not client.database_locked:
+                sys.exit('A daemon is already running, run "mypass lock" first')
+
+            client.unlock_database(BENCHMARK_PASSPHRASE)
+            try:
+                contexts = populate(client, args.size, random.Random(args.seed))
+                for clients in args.clients:
+                    result = run_load(clients, args, contexts)
+                    results['results'][clients] = result
+                    print_report(clients, result)
+            finally:
+                client.call('shutdown')
+
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
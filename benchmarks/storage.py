@@ -0,0 +1,112 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Times the operations of mypass.db.Database on synthetic databases, e.g.:
+#
+#   python3 -m benchmarks.storage --sizes 100 10000 --output results.json
+
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from benchmarks.common import (BENCHMARK_PASSPHRASE, ensure_sqlcipher, isolate_config,
+                               get_metadata, generate_records, summarize, write_results,
+                               print_stats)
+
+SIZES = [100, 10000, 100000]
+
+
+def measure(func, calls):
+    times = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def run_benchmarks(size, args, rand):
+    from mypass.db import Database
+
+    filename = os.path.join(tempfile.mkdtemp(dir=os.environ['HOME']), 'db')
+    records = generate_records(size, rand)
+    results = {}
+
+    def record(name, stats):
+        results[name] = stats
+        print_stats(size, name, stats)
+
+    with Database(filename, BENCHMARK_PASSPHRASE) as db:
+        record('import_credentials', measure(db.import_credentials, [(records,)]))
+
+    def unlock():
+        Database(filename, BENCHMARK_PASSPHRASE).close()
+
+    record('unlock', measure(unlock, [()] * args.unlock_runs))
+
+    with Database(filename, BENCHMARK_PASSPHRASE) as db:
+        contexts = db.get_contexts()
+        new = ['new{}.example.net'.format(i) for i in range(args.runs)]
+        renamed = ['renamed{}.example.net'.format(i) for i in range(args.runs)]
+        aliases = ['alias{}.example.net'.format(i) for i in range(args.runs)]
+
+        record('get_credentials', measure(db.get_credentials,
+                                          [(rand.choice(contexts),) for _ in range(args.runs)]))
+        record('get_contexts', measure(db.get_contexts, [()] * args.list_runs))
+        record('store_credentials', measure(db.store_credentials,
+                                            [(context, 'user', 'password') for context in new]))
+        record('rename_context', measure(db.rename_context, zip(new, renamed)))
+        record('add_context_alias', measure(db.add_context_alias, zip(renamed, aliases)))
+        record('delete_context', measure(db.delete_context, [(context,) for context in renamed + aliases]))
+
+        passphrases = [BENCHMARK_PASSPHRASE + str(i) for i in range(1, args.unlock_runs)] + [BENCHMARK_PASSPHRASE]
+        record('change_passphrase', measure(db.change_passphrase, [(p,) for p in passphrases]))
+
+    results['file_size'] = os.path.getsize(filename)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times database operations on synthetic databases')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='number of contexts of each database')
+    parser.add_argument('--runs', type=int, default=500,
+                        help='number of runs of quick operations')
+    parser.add_argument('--list-runs', type=int, default=20,
+                        help='number of runs of get_contexts')
+    parser.add_argument('--unlock-runs', type=int, default=5,
+                        help='number of runs of unlock and change_passphrase')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', help='config file with settings to use instead of the defaults')
+    parser.add_argument('--output', '-o', default='-')
+    args = parser.parse_args()
+
+    ensure_sqlcipher()
+
+    results = {
+        'benchmark': 'storage',
+        'metadata': get_metadata(),
+        'parameters': vars(args),
+    }
+
+    with tempfile.TemporaryDirectory() as home:
+        isolate_config(home, args.config)
+        rand = random.Random(args.seed)
+        results['results'] = {size: run_benchmarks(size, args, rand) for size in args.sizes}
+
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,37 +12,94 @@
  * for more details.
  */
 
-function revealCredentials(tabId, callback) {
+var port = null;
+var nextRequestId = 1;
+var pendingRequests = Object.create(null);
+
+// Rather than using chrome.runtime.sendNativeMessage(), which starts
+// a new host process for every message, we keep a single port open,
+// so that the host application and its connection to the daemon are
+// reused across requests.
+function sendNativeMessage(message, callback) {
+  if (!port) {
+    port = chrome.runtime.connectNative("org.snoack.mypass");
+
+    port.onMessage.addListener(function(response) {
+      var callback = pendingRequests[response.id];
+      delete pendingRequests[response.id];
+      if (callback)
+        callback(response);
+    });
+
+    port.onDisconnect.addListener(function() {
+      var callbacks = pendingRequests;
+
+      // Accessing lastError prevents it from being logged as unchecked.
+      chrome.runtime.lastError;
+
+      port = null;
+      pendingRequests = Object.create(null);
+
+      for (var id in callbacks)
+        callbacks[id](null);
+    });
+  }
+
+  var request = {id: nextRequestId++};
+  for (var key in message)
+    request[key] = message[key];
+
+  pendingRequests[request.id] = callback || function() {};
+  port.postMessage(request);
+}
+
+function revealCredentials(tabId, context, callback) {
   var pendingFrames = 0;
-  var status = "no-login-form";
+  var loginFrames = [];
 
   var checkDone = function() {
-    if (pendingFrames == 0) {
-      chrome.runtime.onMessage.removeListener(onMessage);
-      callback(status);
+    if (pendingFrames != 0)
+      return;
+
+    chrome.runtime.onMessage.removeListener(onMessage);
+
+    if (loginFrames.length == 0) {
+      callback("no-login-form");
+      return;
     }
+
+    // Look up the credentials for all frames with a login form at once.
+    var message = {
+      action: "get-credentials",
+      urls: loginFrames.map(function(frame) { return frame.url; })
+    };
+    if (context)
+      message.context = context;
+
+    sendNativeMessage(
+      message,
+      function(response) {
+        for (var i = 0; i < loginFrames.length; i++)
+          loginFrames[i].sendResponse(response && response.credentials &&
+                                      response.credentials[i]);
+
+        callback(response ? response.status : "not-installed");
+      }
+    );
   };
 
   var onMessage = function(message, sender, sendResponse) {
     if (message.action != "report-document" || sender.tab.id != tabId)
       return;
 
+    pendingFrames--;
+
     if (message.hasLogin) {
-      chrome.runtime.sendNativeMessage(
-        "org.snoack.mypass",
-        {action: "get-credentials", url: sender.url},
-        function (response) {
-          status = response ? response.status : "not-installed";
-          sendResponse(response && response.credentials);
-
-          pendingFrames--;
-          checkDone();
-        }
-      );
+      loginFrames.push({url: sender.url, sendResponse: sendResponse});
+      checkDone();
       return true;
     }
 
-    pendingFrames--;
     checkDone();
   };
 
@@ -61,11 +118,12 @@ function revealCredentials(tabId, callback) {
 chrome.runtime.onMessage.addListener(function(message, sender, sendResponse) {
   switch (message.action) {
     case "reveal-credentials":
-      revealCredentials(message.tabId, sendResponse);
+      revealCredentials(message.tabId, message.context, sendResponse);
       return true;
 
+    case "search":
     case "unlock-database":
-      chrome.runtime.sendNativeMessage("org.snoack.mypass", message, sendResponse);
+      sendNativeMessage(message, sendResponse);
       return true;
   }
 });
@@ -76,5 +134,5 @@ chrome.runtime.onInstalled.addListener(function() {
 
 chrome.contextMenus.onClicked.addListener(function(info) {
 	if (info.menuItemId == "lock")
-		chrome.runtime.sendNativeMessage("org.snoack.mypass", {action: "lock-database"});
+		sendNativeMessage({action: "lock-database"});
 });
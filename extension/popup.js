@@ -13,10 +13,12 @@
  */
 
 var input = document.getElementById("passphrase");
+var query = document.getElementById("query");
+var results = document.getElementById("results");
 
-function revealCredentials(tabId) {
+function revealCredentials(tabId, context) {
   chrome.runtime.sendMessage(
-    {action: "reveal-credentials", tabId},
+    {action: "reveal-credentials", tabId, context},
     function(status) {
       document.documentElement.dataset.status = status;
 
@@ -25,6 +27,10 @@ function revealCredentials(tabId) {
           input.focus();
           break;
 
+        case "no-credentials":
+          query.focus();
+          break;
+
         case "ok":
           setTimeout(function() { window.close(); }, 1000);
           break;
@@ -54,6 +60,36 @@ chrome.tabs.query({active: true, currentWindow: true}, function(tabs) {
     );
   });
 
+  // If no credentials match the page, the user can search
+  // for them, and pick the ones to fill out the login form with.
+  query.addEventListener("input", function() {
+    var value = query.value;
+
+    chrome.runtime.sendMessage(
+      {action: "search", query: value},
+      function(response) {
+        if (query.value != value)
+          return;
+
+        while (results.firstChild)
+          results.removeChild(results.firstChild);
+
+        if (response && response.contexts)
+          response.contexts.forEach(function(context) {
+            var link = document.createElement("a");
+            link.textContent = context;
+            link.addEventListener("click", function() {
+              revealCredentials(tabId, context);
+            });
+
+            var item = document.createElement("li");
+            item.appendChild(link);
+            results.appendChild(item);
+          });
+      }
+    );
+  });
+
   revealCredentials(tabId);
 });
 
@@ -27,6 +27,14 @@ class DatabaseError(Error):
     pass
 
 
+class ProtocolError(Error):
+    pass
+
+
+class FormatError(Error):
+    pass
+
+
 class CredentialsDoNotExist(Error):
 
     def __str__(self):
@@ -39,6 +47,19 @@ class CredentialsAlreadytExist(Error):
         return 'Credentials already exist'
 
 
+class BatchError(Error):
+
+    def __str__(self):
+        index, message = self.args
+        return 'Command {} of batch failed: {}'.format(index + 1, message)
+
+
+class DatabaseLocked(Error):
+
+    def __str__(self):
+        return 'Database is locked'
+
+
 class ConnectionLost(Error):
 
     def __str__(self):
@@ -0,0 +1,133 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import json
+import asyncio
+import itertools
+
+from mypass import ProtocolError, ConnectionLost, DatabaseLocked, SOCKET
+from mypass.client import Commands
+from mypass.protocol import (MAGIC, VERSION, HELLO, HEADER, check_hello,
+                             check_frame_length, encode_frame, decode_error)
+
+
+class AsyncClient(Commands):
+    # A connection to the daemon that can be used by multiple tasks at
+    # once. Each request is sent with an id, and responses are matched to
+    # the waiting tasks as they arrive, so that a task can be cancelled
+    # without affecting the others, discarding the response it waited for.
+
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._handshake = None
+        self._receiver = None
+        self._drain_lock = None
+        self._ids = itertools.count()
+        self._pending = {}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self):
+        try:
+            self._reader, self._writer = await asyncio.open_unix_connection(SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise DatabaseLocked
+        self._drain_lock = asyncio.Lock()
+        self._writer.write(HELLO.pack(MAGIC, VERSION))
+
+    async def _read_frame(self):
+        length = check_frame_length(HEADER.unpack(await self._reader.readexactly(HEADER.size))[0])
+        try:
+            return json.loads(await self._reader.readexactly(length))
+        except ValueError:
+            raise ProtocolError('Malformed response')
+
+    async def _shake_hands(self, command, args):
+        # The response to the hello is read along with the response to the
+        # first request, which is sent without id, since we don't know yet
+        # whether the daemon supports them. Further requests wait until then.
+        try:
+            self._writer.write(encode_frame([command, list(args)]))
+            version = check_hello(await self._reader.readexactly(HELLO.size))[0]
+            response = await self._read_frame()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise ConnectionLost
+        if version < 2:
+            raise ProtocolError('Daemon does not support concurrent requests')
+
+        self._receiver = asyncio.ensure_future(self._receive())
+        return response
+
+    async def _receive(self):
+        try:
+            while True:
+                id, code, result = await self._read_frame()
+                future = self._pending.pop(id, None)
+                if future and not future.done():
+                    if code:
+                        future.set_exception(decode_error(code, result))
+                    else:
+                        future.set_result(result)
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError, ValueError):
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionLost())
+            self._pending.clear()
+
+    async def call(self, command, *args):
+        if not self._writer:
+            raise ConnectionLost
+
+        # The handshake is shielded, so that cancelling
+        # the first request doesn't affect the others.
+        if not self._handshake:
+            self._handshake = asyncio.ensure_future(self._shake_hands(command, args))
+            code, result = await asyncio.shield(self._handshake)
+            if code:
+                raise decode_error(code, result)
+            return result
+
+        await asyncio.shield(self._handshake)
+        if self._receiver.done():
+            raise ConnectionLost
+
+        id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[id] = future
+        try:
+            self._writer.write(encode_frame([id, command, list(args)]))
+            async with self._drain_lock:
+                await self._writer.drain()
+            return await future
+        except ConnectionError:
+            raise ConnectionLost
+        finally:
+            self._pending.pop(id, None)
+
+    async def close(self):
+        for task in (self._handshake, self._receiver):
+            if task:
+                task.cancel()
+        if self._writer:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
@@ -0,0 +1,327 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import os
+import json
+import time
+import asyncio
+import threading
+import concurrent.futures
+
+from mypass import Error, ProtocolError, SOCKET, trace
+from mypass.config import get_config
+from mypass.daemon import BaseDaemon, Session
+from mypass.protocol import (MAGIC, VERSION, HELLO, HEADER, check_hello,
+                             check_frame_length, is_legacy_request, parse_request,
+                             encode_response, encode_error_response)
+
+
+class AsyncDaemon(BaseDaemon):
+    # Each connection is served by its own task. Commands that only read
+    # from the database run in a pool of threads with a read-only database
+    # connection each, while all other commands run in a single thread,
+    # owning the connection used for writing.
+
+    EXCLUSIVE_COMMANDS = frozenset([
+        'change-passphrase',
+        'reencrypt',
+    ])
+
+    def __init__(self, fd_in, fd_out, timeout):
+        super().__init__(timeout)
+        self._fd_in = fd_in
+        self._fd_out = fd_out
+        self._loop = None
+        self._server = None
+        self._slots = None
+        self._connections = 0
+        self._last_activity = None
+        self._stopped = None
+        self._wakeup = None
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._read_workers = get_config('daemon', 'read_workers')
+        self._readers = concurrent.futures.ThreadPoolExecutor(max_workers=self._read_workers)
+        self._local = threading.local()
+        self._reader_dbs = []
+        self._reader_dbs_lock = threading.Lock()
+        self._generation = 0
+        self._access = None
+        self._reading = 0
+        self._exclusive = 0
+
+    # Handlers access the database through self._db, which refers
+    # to the read-only connection of the current thread, if any.
+
+    @property
+    def _db(self):
+        return getattr(self._local, 'db', None) or self._writer_db
+
+    @_db.setter
+    def _db(self, db):
+        self._writer_db = db
+
+    def _open_reader(self, generation):
+        # Read-only connections are opened in the background, after the
+        # database has been unlocked and after any exclusive command,
+        # so that the key isn't derived again when serving a request.
+        try:
+            with trace.span('open-reader'):
+                db = self._writer_db.open_reader()
+        except Error:
+            return
+
+        # Connections opened before an exclusive command are discarded.
+        with self._reader_dbs_lock:
+            if generation == self._generation:
+                self._reader_dbs.append(db)
+                return
+        db.close()
+
+    def _open_readers(self):
+        for _ in range(self._read_workers):
+            self._loop.run_in_executor(self._readers, self._open_reader, self._generation)
+
+    def _run_reader(self, handler, *args):
+        # Idle connections are shared by all threads. If none is left,
+        # e.g. as opening it in the background failed, one is opened now.
+        with self._reader_dbs_lock:
+            db = self._reader_dbs.pop() if self._reader_dbs else None
+        if not db:
+            with trace.span('open-reader'):
+                db = self._writer_db.open_reader()
+
+        self._local.db = db
+        try:
+            return handler(*args)
+        finally:
+            self._local.db = None
+            with self._reader_dbs_lock:
+                self._reader_dbs.append(db)
+
+    def _run_exclusive(self, handler, *args):
+        # Read-only connections are closed (while none of them is in use),
+        # and opened again afterwards, as the passphrase might have been
+        # changed or the database file has been replaced.
+        with self._reader_dbs_lock:
+            for db in self._reader_dbs:
+                db.close()
+            del self._reader_dbs[:]
+            self._generation += 1
+
+        return handler(*args)
+
+    def _checkpoint(self):
+        # Requests might have been served in the meantime.
+        if self._get_checkpoint_delay((self._loop.time() - self._last_activity) * 1000) == 0:
+            self._db.checkpoint()
+
+    async def _init(self, request, passphrase, listen):
+        await self._loop.run_in_executor(self._writer, self._execute, request,
+                                         self._open_database, [passphrase])
+        self._open_readers()
+
+        if listen:
+            try:
+                os.unlink(SOCKET)
+            except FileNotFoundError:
+                pass
+
+            max_connections = get_config('daemon', 'max_connections')
+            if max_connections:
+                self._slots = asyncio.Semaphore(max_connections)
+
+            self._server = await asyncio.start_unix_server(
+                self._serve_socket, SOCKET,
+                backlog=get_config('daemon', 'backlog')
+            )
+            self._listening = True
+
+    async def _call(self, request, cmd, args):
+        if cmd == 'init':
+            if len(args) != 2:
+                raise ProtocolError('Invalid arguments')
+            return await self._init(request, *args)
+
+        # Commands that don't access the database run in the main thread.
+        handler = self._get_handler(cmd)
+        if cmd in ('shutdown', 'stats'):
+            return self._execute(request, handler, args)
+
+        # Commands that only read run concurrently, while exclusive commands
+        # wait until no command is reading, and block any further reading.
+        async with self._access:
+            if cmd in self.READ_COMMANDS:
+                await self._access.wait_for(lambda: not self._exclusive)
+                self._reading += 1
+            elif cmd in self.EXCLUSIVE_COMMANDS:
+                self._exclusive += 1
+                await self._access.wait_for(lambda: not self._reading)
+
+        try:
+            if cmd in self.READ_COMMANDS:
+                return await self._loop.run_in_executor(self._readers, self._execute, request,
+                                                        self._run_reader, [handler, *args])
+            if cmd in self.EXCLUSIVE_COMMANDS:
+                return await self._loop.run_in_executor(self._writer, self._execute, request,
+                                                        self._run_exclusive, [handler, *args])
+            return await self._loop.run_in_executor(self._writer, self._execute, request, handler, args)
+        finally:
+            async with self._access:
+                if cmd in self.READ_COMMANDS:
+                    self._reading -= 1
+                elif cmd in self.EXCLUSIVE_COMMANDS:
+                    self._exclusive -= 1
+                    self._open_readers()
+                self._access.notify_all()
+
+            # Commands that write might require the database to be
+            # checkpointed, so the main task must recalculate its timeout.
+            if cmd not in self.READ_COMMANDS:
+                self._wakeup.set()
+
+    async def _serve(self, reader, writer):
+        session = Session()
+        self._connections += 1
+        self._stats.connection_opened()
+        self._last_activity = self._loop.time()
+
+        try:
+            # Unlike the poll-based daemon, the legacy
+            # protocol is not supported in this mode.
+            first_byte = await reader.readexactly(1)
+            if is_legacy_request(first_byte[0]):
+                raise ProtocolError('Legacy protocol not supported')
+
+            version, trace = check_hello(first_byte + await reader.readexactly(HELLO.size - 1))
+            version = min(version, VERSION)
+            trace = trace and version >= 3
+            writer.write(HELLO.pack(MAGIC, version))
+
+            while True:
+                length = check_frame_length(HEADER.unpack(await reader.readexactly(HEADER.size))[0])
+                try:
+                    message = json.loads(await reader.readexactly(length))
+                except ValueError:
+                    raise ProtocolError('Malformed request')
+
+                id, cmd, args = parse_request(message, version)
+                self._last_activity = self._loop.time()
+                request = self._stats.begin(cmd, trace)
+
+                try:
+                    result = await self._call(request, cmd, args)
+                except Error as e:
+                    request.failed = True
+                    start = time.perf_counter()
+                    response = encode_error_response(id, e, self._get_server_timing(request))
+                else:
+                    self._update_session(session, cmd, args, result)
+                    start = time.perf_counter()
+                    response = encode_response(id, result, self._get_server_timing(request))
+
+                request.serialize = time.perf_counter() - start
+                self._stats.end(request)
+                writer.write(response)
+                await writer.drain()
+
+                if self._shutdown:
+                    self._stop()
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            writer.close()
+
+            # Exports are ended in the thread owning the cursors.
+            if session.imports or session.exports:
+                await self._loop.run_in_executor(self._writer, self._end_session, session)
+
+            self._connections -= 1
+            self._stats.connection_closed()
+            self._last_activity = self._loop.time()
+
+            if not self._server and not self._connections:
+                self._stop()
+
+    async def _serve_socket(self, reader, writer):
+        # Once the limit of connections is reached, further
+        # connections are accepted but wait for a free slot.
+        if self._slots:
+            async with self._slots:
+                await self._serve(reader, writer)
+        else:
+            await self._serve(reader, writer)
+
+    async def _connect_pipe(self):
+        reader = asyncio.StreamReader()
+        await self._loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader),
+            os.fdopen(self._fd_in, 'rb', 0, closefd=False)
+        )
+        transport, protocol = await self._loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin,
+            os.fdopen(self._fd_out, 'wb', 0, closefd=False)
+        )
+        return reader, asyncio.StreamWriter(transport, protocol, reader, self._loop)
+
+    def _stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    async def _main(self):
+        self._stopped = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._access = asyncio.Condition()
+        self._last_activity = self._loop.time()
+        self._loop.create_task(self._serve(*await self._connect_pipe()))
+
+        while not self._stopped.is_set():
+            idle = (self._loop.time() - self._last_activity) * 1000
+            timeout = (self._timeout - idle) / 1000
+            if timeout <= 0:
+                break
+
+            checkpoint_delay = self._get_checkpoint_delay(idle)
+            if checkpoint_delay == 0:
+                await self._loop.run_in_executor(self._writer, self._checkpoint)
+                continue
+            if checkpoint_delay is not None:
+                timeout = min(timeout, checkpoint_delay / 1000)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        if self._server:
+            self._server.close()
+
+    def run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+
+        try:
+            self._loop.run_until_complete(self._main())
+
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            self._loop.close()
+
+    def close(self):
+        self._writer.shutdown()
+        self._readers.shutdown()
+        for db in self._reader_dbs:
+            db.close()
+        super().close()
@@ -13,10 +13,8 @@
 import sys
 import struct
 import json
-import re
-import urllib.parse
 
-from mypass import CredentialsDoNotExist
+from mypass import DatabaseError, CredentialsDoNotExist, trace
 from mypass.client import Client, database_exists, ConnectionLost
 
 
@@ -33,40 +31,54 @@ def send_response(message):
     sys.stdout.buffer.flush()
 
 
-def get_possible_contexts(url):
-    parsed = urllib.parse.urlparse(url)
-    parts = parsed.path.split('/')
-
-    while parts:
-        yield parsed.netloc + '/'.join(parts)
-
-        tail = parts.pop()
-        if tail != '':
-            parts.append('')
-
-    if re.search(r'[^0-9.:]', parsed.netloc):
-        parts = parsed.netloc.split('.')
-
-        while len(parts) > 2:
-            del parts[0]
-            yield '.'.join(parts)
-
-
 class NativeMessagingHost:
 
     def __init__(self):
-        while True:
-            length_bytes = sys.stdin.buffer.read(4)
-            if not length_bytes:
-                break
-
-            send_response(self._process_request(parse_request(length_bytes)))
+        self._client = None
+        trace.record('import', trace.IMPORTED)
+
+        try:
+            while True:
+                length_bytes = sys.stdin.buffer.read(4)
+                if not length_bytes:
+                    break
+
+                with trace.span('read-request'):
+                    request = parse_request(length_bytes)
+                with trace.span('process ' + str(request.get('action'))):
+                    response = self._process_request(request)
+
+                # Requests sent through a port created with connectNative()
+                # carry an ID so that the extension can match the response.
+                if 'id' in request:
+                    response['id'] = request['id']
+
+                with trace.span('send-response'):
+                    send_response(response)
+        finally:
+            self._close_client()
+
+    def _get_client(self):
+        # Keep the connection to the daemon open across requests,
+        # but try to connect again as long as the database is locked,
+        # since it might have been unlocked by another process meanwhile.
+        if not self._client or self._client.database_locked:
+            self._close_client()
+            self._client = Client()
+
+        return self._client
+
+    def _close_client(self):
+        if self._client:
+            self._client.close()
+            self._client = None
 
     def _handle_unlock_database(self, client, request):
         if client.database_locked:
             try:
                 client.unlock_database(request['passphrase'])
-            except ConnectionLost:
+            except (ConnectionLost, DatabaseError):
+                self._close_client()
                 return {'status': 'failure'}
 
         return {'status': 'ok'}
@@ -74,6 +86,7 @@ class NativeMessagingHost:
     def _handle_lock_database(self, client, request):
         if not client.database_locked:
             client.call('shutdown')
+            self._close_client()
 
         return {'status': 'ok'}
 
@@ -81,19 +94,48 @@ class NativeMessagingHost:
         if client.database_locked:
             return {'status': 'database-locked'}
 
-        for context in get_possible_contexts(request['url']):
+        # Resolve the credentials for all frames of a tab with
+        # a single request, if the extension provides multiple URLs.
+        urls = request.get('urls')
+        if urls is None:
+            urls = [request['url']]
+
+        # If a context has been chosen explicitly,
+        # e.g. from the search results in the popup,
+        # its credentials are used for all frames.
+        if 'context' in request:
             try:
-                credentials = client.call('get-credentials', context)
+                results = [client.call('get-credentials', request['context'])] * len(urls)
             except CredentialsDoNotExist:
-                continue
-
-            return {'status': 'ok', 'credentials': [dict(zip(['username', 'password'], token)) for token in credentials]}
+                results = [None] * len(urls)
+        else:
+            results = client.call('match-credentials', urls)
+        credentials = [result and [dict(zip(['username', 'password'], token)) for token in result]
+                       for result in results]
+
+        if not any(credentials):
+            return {'status': 'no-credentials'}
+        if 'urls' in request:
+            return {'status': 'ok', 'credentials': credentials}
+        return {'status': 'ok', 'credentials': credentials[0]}
+
+    def _handle_search(self, client, request):
+        if client.database_locked:
+            return {'status': 'database-locked'}
 
-        return {'status': 'no-credentials'}
+        return {'status': 'ok', 'contexts': client.call('search', request['query'], request.get('limit', 10))}
 
     def _process_request(self, request):
-        if not database_exists():
+        handler = getattr(self, '_handle_' + request['action'].replace('-', '_'))
+        client = self._get_client()
+
+        if client.database_locked and not database_exists():
             return {'status': 'database-does-not-exist'}
 
-        with Client() as client:
-            return getattr(self, '_handle_' + request['action'].replace('-', '_'))(client, request)
+        try:
+            return handler(client, request)
+        except ConnectionLost:
+            # The daemon has shut down since the last request,
+            # e.g. due to inactivity, so start over with a new connection.
+            self._close_client()
+            return handler(self._get_client(), request)
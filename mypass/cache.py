@@ -0,0 +1,131 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import bisect
+import threading
+from collections import OrderedDict
+
+# Contexts are compared case-insensitively, but like SQLite's NOCASE
+# collation, only ASCII characters are folded, so that the cached list
+# of contexts is sorted the same way as when queried from the database.
+_NOCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+                        'abcdefghijklmnopqrstuvwxyz')
+
+
+def _nocase(context):
+    return context.translate(_NOCASE)
+
+
+class CredentialsCache:
+    # Data queried from the database is only added to the cache if the
+    # cache hasn't been invalidated since the query started, i.e. the
+    # version passed must be the one at the time before the query.
+
+    def __init__(self, max_entries):
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._ids = {}
+        self._contexts_by_id = {}
+        self._credentials = OrderedDict()
+        self._contexts = None
+        self._context_keys = None
+        self.version = 0
+
+    def get_credentials(self, context):
+        with self._lock:
+            id = self._ids.get(_nocase(context))
+            credentials = self._credentials.get(id)
+            if credentials is not None:
+                self._credentials.move_to_end(id)
+            return credentials
+
+    def _add_credentials(self, context, id, credentials):
+        self._ids[_nocase(context)] = id
+        self._contexts_by_id.setdefault(id, set()).add(_nocase(context))
+        self._credentials[id] = credentials
+        self._credentials.move_to_end(id)
+
+        # Evict the least recently used credentials along
+        # with the contexts referring to them.
+        while len(self._credentials) > self._max_entries:
+            self._forget(self._credentials.popitem(last=False)[0])
+
+    def add_credentials(self, context, id, credentials, version):
+        with self._lock:
+            if version == self.version:
+                self._add_credentials(context, id, credentials)
+
+    def get_contexts(self):
+        with self._lock:
+            if self._contexts is not None:
+                return list(self._contexts)
+
+    def set_contexts(self, contexts, version):
+        with self._lock:
+            if version == self.version:
+                self._contexts = list(contexts)
+                self._context_keys = [_nocase(context) for context in self._contexts]
+
+    def warm(self, rows, version):
+        # The rows are expected to be ordered by id and username, with
+        # a row for each combination of context and username of an id.
+        credentials = OrderedDict()
+        for context, id, username, password in rows:
+            contexts, tokens = credentials.setdefault(id, ([], []))
+            if context not in contexts:
+                contexts.append(context)
+            if not tokens or tokens[-1] != (username, password):
+                tokens.append((username, password))
+
+        with self._lock:
+            if version != self.version:
+                return
+
+            for id, (contexts, tokens) in credentials.items():
+                if len(self._credentials) >= self._max_entries:
+                    break
+                if id not in self._credentials:
+                    for context in contexts:
+                        self._add_credentials(context, id, tokens)
+
+    def _forget(self, id):
+        self._credentials.pop(id, None)
+        for key in self._contexts_by_id.pop(id, ()):
+            if self._ids.get(key) == id:
+                del self._ids[key]
+
+    def _update_contexts(self, change, context):
+        if self._contexts is None:
+            return
+
+        key = _nocase(context)
+        index = bisect.bisect_left(self._context_keys, key)
+        found = index < len(self._context_keys) and self._context_keys[index] == key
+
+        if change == 'add' and not found:
+            self._context_keys.insert(index, key)
+            self._contexts.insert(index, context)
+        elif change == 'remove' and found:
+            del self._context_keys[index]
+            del self._contexts[index]
+
+    def update(self, changes):
+        with self._lock:
+            self.version += 1
+
+            for change, context, id in changes:
+                if context is not None:
+                    old_id = self._ids.pop(_nocase(context), None)
+                    if old_id is not None:
+                        self._forget(old_id)
+                    self._update_contexts(change, context)
+                self._forget(id)
@@ -10,37 +10,20 @@
 # or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
 # for more details.
 
+import os
 import sys
-import random
-import string
-import argparse
+import itertools
 from getpass import getpass
 
-try:
-    import argcomplete
-except ImportError:
-    argcomplete = None
-
-from mypass import Error, CredentialsDoNotExist, CredentialsAlreadytExist
+from mypass import Error, CredentialsAlreadytExist, BatchError, DatabaseLocked, trace
 from mypass.client import Client, database_exists
-from mypass.config import get_config
-
-
-def generate_password(length):
-    rand = random.SystemRandom()
-
-    chars = [
-        rand.choice(string.ascii_lowercase),
-        rand.choice(string.ascii_uppercase),
-        rand.choice(string.digits),
-        rand.choice(string.punctuation),
-    ]
+from mypass.completion import COMPLETION_LIMIT
 
-    while len(chars) < length:
-        chars.append(chr(rand.randint(33, 126)))
+# Modules only needed to parse the command line, or by some commands,
+# are imported on demand, so that CLI._call_simple() starts fast.
 
-    rand.shuffle(chars)
-    return ''.join(chars)[:length]
+IMPORT_CHUNK_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
 
 
 def prompt_new_passphrase():
@@ -53,38 +36,109 @@ def prompt_new_passphrase():
     return passphrase
 
 
-def complete_context(**kwargs):
+def open_input(filename):
+    if filename == '-':
+        return open(sys.stdin.fileno(), encoding='utf-8', newline='', closefd=False)
+    return open(filename, encoding='utf-8', newline='')
+
+
+def open_output(filename):
+    if filename == '-':
+        return open(sys.stdout.fileno(), 'w', encoding='utf-8', newline='', closefd=False)
+
+    # The exported credentials aren't encrypted,
+    # so don't make the file readable for others.
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    return open(fd, 'w', encoding='utf-8', newline='')
+
+
+def parse_env_mapping(value):
+    import argparse
+
+    # The username is separated by the last colon, so that contexts
+    # containing a colon must be followed by a colon and the username.
+    name, sep, target = value.partition('=')
+    if not (sep and name and target):
+        raise argparse.ArgumentTypeError('expected NAME=context[:username], got {!r}'.format(value))
+    context, sep, username = target.rpartition(':')
+    if not sep:
+        return name, target, None
+    return name, context, username
+
+
+def create_secret_file(name, secret):
+    # Secrets are passed as files in memory, that are never written
+    # to disk, and only accessible through the inherited file descriptor.
+    if not hasattr(os, 'memfd_create'):
+        raise Error('Passing secrets as files is not supported on this platform')
+
+    fd = os.memfd_create(name)
+    os.write(fd, secret.encode('utf-8'))
+    os.set_inheritable(fd, True)
+    return '/dev/fd/{}'.format(fd)
+
+
+def complete_context(prefix, **kwargs):
     with Client() as client:
         if not client.database_locked:
-            return client.call('get-contexts')
+            return client.call('complete-contexts', prefix, COMPLETION_LIMIT)
     return []
 
 
 def complete_username(parsed_args, **kwargs):
     with Client() as client:
         if not client.database_locked:
-            try:
-                return [user for user, _ in client.call('get-credentials',
-                                                        parsed_args.context)]
-            except CredentialsDoNotExist:
-                pass
+            return client.call('get-usernames', parsed_args.context)
     return []
 
 
+def print_credentials(credentials):
+    with trace.span('output'):
+        if len(credentials) == 1 and credentials[0][0] == '':
+            print(credentials[0][1])
+            return
+
+        username_width = max(len(token[0]) for token in credentials) + 2
+        for username, password in credentials:
+            print(username.ljust(username_width), end='')
+            print(password)
+
+
+def print_contexts(contexts):
+    with trace.span('output'):
+        for context in contexts:
+            print(context)
+
+
 class CLI:
 
     def __init__(self, args=None):
+        if args is None:
+            args = sys.argv[1:]
+
+        trace.record('import', trace.IMPORTED)
+
         try:
-            self._parser = get_argument_parser()
+            if self._call_simple(args):
+                return
 
-            if argcomplete:
-                argcomplete.autocomplete(self._parser, default_completer=None)
+            with trace.span('parse-arguments'):
+                self._parser = get_argument_parser()
 
-            self._args = self._parser.parse_args(args=args)
+                try:
+                    import argcomplete
+                except ImportError:
+                    pass
+                else:
+                    argcomplete.autocomplete(self._parser, default_completer=None)
+
+                self._args = self._parser.parse_args(args=args)
 
             with Client() as self._client:
-                self._open_database()
-                getattr(self, '_call_' + self._args.command)()
+                if getattr(self._args, 'open_db', True):
+                    self._open_database()
+                with trace.span('run ' + self._args.command):
+                    getattr(self, '_call_' + self._args.command)()
         except Error as e:
             print(e, file=sys.stderr)
             sys.exit(1)
@@ -92,6 +146,23 @@ class CLI:
             print(file=sys.stderr)
             sys.exit(1)
 
+    def _call_simple(self, args):
+        # Getting credentials and listing contexts is done without building
+        # the argument parser, if the database is unlocked, and no options
+        # are given, as otherwise startup takes longer than the command.
+        if args == ['list']:
+            command, args, output = 'get-contexts', (), print_contexts
+        elif len(args) == 2 and args[0] == 'get' and not args[1].startswith('-'):
+            command, args, output = 'get-credentials', args[1:], print_credentials
+        else:
+            return False
+
+        with Client() as client:
+            if client.database_locked:
+                return False
+            output(client.call(command, *args))
+        return True
+
     def _open_database(self):
         if self._client.database_locked:
             if getattr(self._args, 'exit_if_db_locked', False):
@@ -120,16 +191,7 @@ class CLI:
             self._client.call(*(args + (True,)))
 
     def _call_get(self):
-        credentials = self._client.call('get-credentials', self._args.context)
-
-        if len(credentials) == 1 and credentials[0][0] == '':
-            print(credentials[0][1])
-            return
-
-        username_width = max(len(token[0]) for token in credentials) + 2
-        for username, password in credentials:
-            print(username.ljust(username_width), end='')
-            print(password)
+        print_credentials(self._client.call('get-credentials', self._args.context))
 
     def _call_add(self, password=None):
         self._check_override('store-credentials',
@@ -137,8 +199,28 @@ class CLI:
                              self._args.username,
                              password or self._args.password or getpass())
 
-    def _call_new(self):
+    def _get_password_generator(self):
+        from mypass.config import get_config
+        from mypass.generator import PasswordGenerator, PassphraseGenerator, read_wordlist
+
+        # Passphrases are generated if the number of words is given,
+        # or configured, unless the length of a password is given.
         length = self._args.length
+        words = self._args.words
+        if words is None and length is None:
+            words = get_config('password', 'words') or None
+
+        if words is not None:
+            if not (1 <= words <= 100):
+                self._parser.error('Number of words must be between 1 and 100, '
+                                   'at least 6 is recommended')
+
+            wordlist = get_config('password', 'wordlist')
+            if not wordlist:
+                raise Error('No wordlist configured, set wordlist in section [password] of the config file')
+
+            generator = PassphraseGenerator(read_wordlist(wordlist))
+            return lambda: generator.generate(words)
 
         if length is None:
             length = get_config('password', 'length')
@@ -150,10 +232,40 @@ class CLI:
                                'between {} and {}, at least 16 '
                                'is recommended'.format(min_length, max_length))
 
-        password = generate_password(length)
+        generator = PasswordGenerator(get_config('password', 'characters').split())
+        return lambda: generator.generate(length)
+
+    def _call_new(self):
+        password = self._get_password_generator()()
         self._call_add(password)
         print(password)
 
+    def _call_rotate(self):
+        import fnmatch
+
+        generate = self._get_password_generator()
+        pattern = self._args.pattern.lower()
+        contexts = [context for context in self._client.call('get-contexts')
+                    if fnmatch.fnmatchcase(context.lower(), pattern)]
+        if not contexts:
+            raise Error('No contexts match {!r}'.format(self._args.pattern))
+
+        # All passwords are replaced in a single transaction. Contexts that
+        # are aliases of each other end up with the password generated last.
+        calls = []
+        results = self._client.call('find-credentials', [[context] for context in contexts])
+        for context, credentials in zip(contexts, results):
+            for username, _ in credentials or []:
+                calls.append(('store-credentials', [context, username, generate(), True]))
+                print('{}  {}'.format(context, username) if username else context)
+
+        if not self._args.dry_run:
+            self._client.batch(calls)
+
+        print('{} passwords rotated'.format(len(calls)))
+        if self._args.dry_run:
+            print('Dry run, no changes have been made')
+
     def _call_remove(self):
         context = self._args.context
         username = self._args.username
@@ -180,20 +292,334 @@ class CLI:
             self._check_override('rename-context', old_context, new_context)
 
     def _call_list(self):
-        for context in self._client.call('get-contexts'):
+        print_contexts(self._client.call('get-contexts'))
+
+    def _call_search(self):
+        if self._args.limit < 1:
+            self._parser.error('Limit must be at least 1')
+
+        for context in self._client.call('search', self._args.query, self._args.limit):
             print(context)
 
+    def _call_import(self):
+        from mypass.formats import guess_format, read_records
+
+        filename = self._args.file
+        format = self._args.format or guess_format(filename)
+        show_progress = sys.stderr.isatty()
+        error = None
+
+        # Errors while reading the input end the stream of chunks
+        # gracefully, so that responses to pending requests are
+        # consumed before the import is aborted.
+        def get_chunks():
+            nonlocal error
+            try:
+                with open_input(filename) as file:
+                    records = read_records(file, format)
+                    while error is None:
+                        chunk = list(itertools.islice(records, IMPORT_CHUNK_SIZE))
+                        if not chunk:
+                            break
+                        yield 'add-import-records', (import_id, chunk)
+            except (Error, OSError, UnicodeDecodeError) as e:
+                error = e
+
+        # The staged records are discarded if the import fails or is
+        # interrupted, or otherwise by the daemon, once disconnected.
+        def abort():
+            try:
+                self._client.call('abort-import', import_id)
+            except Error:
+                pass
+
+        import_id = self._client.call('begin-import')
+        count = 0
+
+        try:
+            for index, result in self._client.call_many(get_chunks(), window=4):
+                if isinstance(result, Error):
+                    error = error or result
+                    continue
+
+                count = max(count, result)
+                if show_progress and count > IMPORT_CHUNK_SIZE:
+                    print('\rRead {} records'.format(count), end='', file=sys.stderr)
+
+            if show_progress and count > IMPORT_CHUNK_SIZE:
+                print(file=sys.stderr)
+        except BaseException:
+            abort()
+            raise
+
+        if error:
+            abort()
+            if isinstance(error, UnicodeDecodeError):
+                raise Error('Unexpected encoding in input')
+            if isinstance(error, OSError):
+                raise Error('{}: {}'.format(filename, error.strerror))
+            raise error
+
+        try:
+            report = self._client.call('commit-import', import_id,
+                                       self._args.on_conflict,
+                                       self._args.dry_run)
+        except CredentialsAlreadytExist:
+            print('Credentials already exist, use --on-conflict=skip or '
+                  '--on-conflict=override in order to import anyway', file=sys.stderr)
+            sys.exit(1)
+
+        print('{added} added, {updated} updated, {skipped} skipped'.format(**report))
+        if self._args.dry_run:
+            print('Dry run, no changes have been made')
+
+    def _call_export(self):
+        from mypass.formats import guess_format, get_record_writer
+
+        filename = self._args.file
+        format = self._args.format or guess_format(filename)
+        export_id = self._client.call('begin-export', self._args.compact)
+        error = None
+        done = False
+
+        # Chunks are requested ahead, until an empty chunk is returned,
+        # so that the daemon can already read the next chunk while the
+        # previous one is written.
+        def get_calls():
+            while not done:
+                yield 'get-export-records', (export_id, EXPORT_CHUNK_SIZE)
+
+        # Errors end the stream of requests gracefully, so that responses
+        # to pending requests are consumed before the export is ended.
+        try:
+            with open_output(filename) as file:
+                write = get_record_writer(file, format, self._args.compact)
+
+                for index, records in self._client.call_many(get_calls(), window=4):
+                    if isinstance(records, Error):
+                        error = error or records
+                    if not records or error:
+                        done = True
+                        continue
+
+                    try:
+                        write(records)
+                    except OSError as e:
+                        error = e
+        except OSError as e:
+            error = error or e
+        finally:
+            # The cursor must be closed, even if interrupted, as it
+            # prevents the database from being checkpointed otherwise.
+            self._client.call('end-export', export_id)
+
+        if isinstance(error, OSError):
+            raise Error('{}: {}'.format(filename, error.strerror))
+        if error:
+            raise error
+
+    def _call_batch(self):
+        import shlex
+
+        filename = self._args.file
+        parser = get_batch_parser()
+        calls = []
+        lines = []
+
+        try:
+            with open_input(filename) as file:
+                for lineno, line in enumerate(file, 1):
+                    try:
+                        words = shlex.split(line, comments=True)
+                        if words:
+                            args = parser.parse_args(words)
+                            calls.append(args.get_call(args))
+                            lines.append(lineno)
+                    except (Error, ValueError) as e:
+                        raise Error('Line {}: {}'.format(lineno, e))
+        except UnicodeDecodeError:
+            raise Error('Unexpected encoding in input')
+        except OSError as e:
+            raise Error('{}: {}'.format(filename, e.strerror))
+
+        try:
+            self._client.batch(calls)
+        except BatchError as e:
+            index, message = e.args
+            raise Error('Line {}: {}, no changes have been made'.format(lines[index], message))
+
+        print('{} commands applied'.format(len(calls)))
+
     def _call_alias(self):
         self._check_override('add-context-alias', self._args.context, self._args.alias)
 
+    def _call_exec(self):
+        mappings = self._args.env or []
+        command = self._args.cmd
+        if command[:1] == ['--']:
+            command = command[1:]
+        if not command:
+            self._parser.error('No command given')
+
+        # All credentials are looked up in a single request,
+        # before running the command in place of this process.
+        secrets = {}
+        results = self._client.call('find-credentials', [[context] for name, context, username in mappings])
+        for (name, context, username), credentials in zip(mappings, results):
+            if not credentials:
+                raise Error('{}: Credentials do not exist'.format(context))
+            if username is not None:
+                credentials = [c for c in credentials if c[0] == username]
+                if not credentials:
+                    raise Error('{}: Credentials do not exist for {!r}'.format(context, username))
+            elif len(credentials) > 1:
+                raise Error('{}: Multiple credentials exist, the username must be given'.format(context))
+            secrets[name] = credentials[0][1]
+
+        env = dict(os.environ)
+        for name, password in secrets.items():
+            if self._args.files:
+                env[name] = create_secret_file(name, password)
+            else:
+                env[name] = password
+
+        self._client.close()
+        sys.stdout.flush()
+        try:
+            os.execvpe(command[0], command, env)
+        except OSError as e:
+            raise Error('{}: {}'.format(command[0], e.strerror))
+
     def _call_changepw(self):
         self._client.call('change-passphrase', prompt_new_passphrase())
 
+    def _call_reencrypt(self):
+        self._client.call('reencrypt')
+
+    def _call_calibrate(self):
+        import time
+        import hashlib
+        from mypass.db import get_cipher_settings
+
+        if self._args.time <= 0:
+            self._parser.error('Time must be positive')
+
+        algorithm = get_cipher_settings()['cipher_kdf_algorithm']
+        hash_name = algorithm[len('PBKDF2_HMAC_'):].lower()
+
+        # Iterations are doubled until the key derivation
+        # takes long enough to be measured reliably.
+        iterations = 1000
+        while True:
+            start = time.perf_counter()
+            hashlib.pbkdf2_hmac(hash_name, b'passphrase', os.urandom(16), iterations)
+            elapsed = time.perf_counter() - start
+            if elapsed >= 0.2:
+                break
+            iterations *= 2
+
+        kdf_iter = max(int(round(iterations / elapsed * self._args.time, -3)), 1000)
+        print('kdf_iter = {}'.format(kdf_iter))
+
+    def _call_stats(self):
+        import json
+        from datetime import timedelta
+        from mypass.stats import get_percentile
+
+        if self._client.database_locked:
+            raise DatabaseLocked
+
+        stats = self._client.call('stats')
+        if self._args.json:
+            print(json.dumps(stats, indent=2))
+            return
+
+        print('Uptime: {}'.format(timedelta(seconds=int(stats['uptime']))))
+        print('Connections: {} open, {} total'.format(stats['connections'], stats['total_connections']))
+        print()
+
+        row = '{:<20} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'
+        print(row.format('Command', 'Count', 'Errors', 'Mean ms', 'p50 ms', 'p95 ms',
+                         'p99 ms', 'Max ms', 'Exec ms', 'Ser ms'))
+        for command, command_stats in sorted(stats['commands'].items()):
+            count = command_stats['count']
+            print(row.format(
+                command, count, command_stats['errors'],
+                *('{:.3f}'.format(value) for value in [
+                    command_stats['time'] / count,
+                    get_percentile(command_stats, stats['buckets'], 0.5),
+                    get_percentile(command_stats, stats['buckets'], 0.95),
+                    get_percentile(command_stats, stats['buckets'], 0.99),
+                    command_stats['max'],
+                    command_stats['execute'] / count,
+                    command_stats['serialize'] / count,
+                ])
+            ))
+
     def _call_lock(self):
         self._client.call('shutdown')
 
 
+def get_batch_parser():
+    import argparse
+
+    # Commands read by "mypass batch" are parsed like the arguments of the
+    # respective mypass command, raising an error rather than exiting.
+    class BatchArgumentParser(argparse.ArgumentParser):
+        def error(self, message):
+            raise Error(message)
+
+    parser = BatchArgumentParser(prog='batch', add_help=False)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    def get_rename_call(args):
+        if args.username is not None or args.new_username is not None:
+            return 'rename-credentials', [args.context, args.username or '',
+                                          args.new_context or args.context,
+                                          args.new_username or '', args.override]
+        return 'rename-context', [args.context, args.new_context or args.context, args.override]
+
+    parser_add = subparsers.add_parser('add', add_help=False)
+    parser_add.add_argument('context')
+    parser_add.add_argument('username', nargs='?', default='')
+    parser_add.add_argument('password')
+    parser_add.add_argument('--override', action='store_true')
+    parser_add.set_defaults(get_call=lambda args: ('store-credentials', [
+        args.context, args.username, args.password, args.override
+    ]))
+
+    parser_remove = subparsers.add_parser('remove', add_help=False)
+    parser_remove.add_argument('context')
+    parser_remove.add_argument('username', nargs='?')
+    parser_remove.set_defaults(get_call=lambda args: (
+        ('delete-context', [args.context]) if args.username is None else
+        ('delete-credentials', [args.context, args.username])
+    ))
+
+    parser_rename = subparsers.add_parser('rename', add_help=False)
+    parser_rename.add_argument('context')
+    parser_rename.add_argument('username', nargs='?')
+    parser_rename.add_argument('--new-context')
+    parser_rename.add_argument('--new-username')
+    parser_rename.add_argument('--override', action='store_true')
+    parser_rename.set_defaults(get_call=get_rename_call)
+
+    parser_alias = subparsers.add_parser('alias', add_help=False)
+    parser_alias.add_argument('context')
+    parser_alias.add_argument('alias')
+    parser_alias.add_argument('--override', action='store_true')
+    parser_alias.set_defaults(get_call=lambda args: ('add-context-alias', [
+        args.context, args.alias, args.override
+    ]))
+
+    return parser
+
+
 def get_argument_parser():
+    import argparse
+    from mypass.formats import FORMATS
+
     parser = argparse.ArgumentParser(
         prog='mypass',
         description='A secure password manager with command line interface',
@@ -216,6 +642,14 @@ def get_argument_parser():
     subparser_new.add_argument('context').completer = complete_context
     subparser_new.add_argument('username', nargs='?', default='')
     subparser_new.add_argument('--length', '-l', type=int)
+    subparser_new.add_argument('--words', '-w', type=int)
+
+    subparser_rotate = subparsers.add_parser('rotate', help='Generates new passwords for all credentials of the contexts matching the given pattern')
+    subparser_rotate.add_argument('pattern').completer = complete_context
+    subparser_rotate.add_argument('--length', '-l', type=int)
+    subparser_rotate.add_argument('--words', '-w', type=int)
+    subparser_rotate.add_argument('--dry-run', '-n', action='store_true')
+    subparser_rotate.set_defaults(fail_if_db_does_not_exist=True)
 
     subparser_remove = subparsers.add_parser('remove', help='Removes a password from the database')
     subparser_remove.add_argument('context').completer = complete_context
@@ -232,14 +666,52 @@ def get_argument_parser():
     subparser_list = subparsers.add_parser('list', help='Writes the contexts of all passwords to stdout')
     subparser_list.set_defaults(fail_if_db_does_not_exist=True)
 
+    subparser_search = subparsers.add_parser('search', help='Writes the contexts best matching the given query to stdout')
+    subparser_search.add_argument('query')
+    subparser_search.add_argument('--limit', '-n', type=int, default=20)
+    subparser_search.set_defaults(fail_if_db_does_not_exist=True)
+
+    subparser_import = subparsers.add_parser('import', help='Adds the credentials read from a CSV or JSON Lines file to the database')
+    subparser_import.add_argument('file', nargs='?', default='-')
+    subparser_import.add_argument('--format', '-f', choices=FORMATS)
+    subparser_import.add_argument('--on-conflict', choices=['fail', 'skip', 'override'], default='fail')
+    subparser_import.add_argument('--dry-run', '-n', action='store_true')
+
+    subparser_export = subparsers.add_parser('export', help='Writes all credentials to a CSV or JSON Lines file')
+    subparser_export.add_argument('file', nargs='?', default='-')
+    subparser_export.add_argument('--format', '-f', choices=FORMATS)
+    subparser_export.add_argument('--compact', '-c', action='store_true')
+    subparser_export.set_defaults(fail_if_db_does_not_exist=True)
+
+    subparser_batch = subparsers.add_parser('batch', help='Runs the add, remove, rename and alias commands read from a file at once')
+    subparser_batch.add_argument('file', nargs='?', default='-')
+
     subparser_alias = subparsers.add_parser('alias', help='Creates a new context that refers to the credentials of an existing context')
     subparser_alias.add_argument('context').completer = complete_context
     subparser_alias.add_argument('alias')
     subparser_alias.set_defaults(fail_if_db_does_not_exist=True)
 
+    subparser_exec = subparsers.add_parser('exec', help='Runs a command with the given passwords in its environment')
+    subparser_exec.add_argument('--env', '-e', metavar='NAME=CONTEXT[:USERNAME]', action='append', type=parse_env_mapping)
+    subparser_exec.add_argument('--files', action='store_true',
+                                help='pass the paths of in-memory files containing the passwords instead')
+    subparser_exec.add_argument('cmd', nargs=argparse.REMAINDER)
+    subparser_exec.set_defaults(fail_if_db_does_not_exist=True)
+
     subparser_changepw = subparsers.add_parser('changepw', help='Changes the master passphrase')
     subparser_changepw.set_defaults(fail_if_db_does_not_exist=True)
 
+    subparser_reencrypt = subparsers.add_parser('reencrypt', help='Re-encrypts the database using the configured cipher settings')
+    subparser_reencrypt.set_defaults(fail_if_db_does_not_exist=True)
+
+    subparser_calibrate = subparsers.add_parser('calibrate', help='Suggests a number of key derivation iterations for the given unlock time')
+    subparser_calibrate.add_argument('--time', '-t', type=float, default=0.5)
+    subparser_calibrate.set_defaults(open_db=False)
+
+    subparser_stats = subparsers.add_parser('stats', help='Writes statistics about the requests served by the daemon to stdout')
+    subparser_stats.add_argument('--json', action='store_true')
+    subparser_stats.set_defaults(open_db=False)
+
     subparser_lock = subparsers.add_parser('lock', help='Closes the database and forgets the master passhrase')
     subparser_lock.set_defaults(exit_if_db_locked=True)
 
@@ -12,34 +12,161 @@
 
 import sys
 import os
+import json
+import time
 import socket
-import pickle
-import subprocess
-import ctypes.util
+import threading
 
-from mypass import Error, ConnectionLost, SOCKET
-from mypass.config import get_config
+from mypass import Error, ConnectionLost, DatabaseLocked, SOCKET, trace
+from mypass.protocol import ClientConnection
 
+# Modules only needed to spawn the daemon are imported on demand,
+# so that commands are fast if the daemon is already running.
 
-def _spawn_daemon():
+
+def _get_library_key(lib):
+    # Libraries found by name (rather than path) are resolved through
+    # the linker cache, which is rebuilt when libraries are installed.
+    st = os.stat(lib if os.path.isabs(lib) else '/etc/ld.so.cache')
+    return [st.st_dev, st.st_ino, st.st_mtime_ns, os.environ.get('LD_LIBRARY_PATH', '')]
+
+
+def _find_sqlcipher():
+    from mypass.config import DATA_DIR, get_config
+
+    lib = get_config('database', 'sqlcipher_library')
+    if lib:
+        return lib
+
+    # Searching for the library might run ldconfig or even the compiler,
+    # so the result is cached, as long as the library (or linker cache)
+    # doesn't change.
+    cache_file = os.path.join(os.path.expanduser(DATA_DIR), 'sqlcipher.json')
+    try:
+        with open(cache_file) as file:
+            cached = json.load(file)
+        if cached['key'] == _get_library_key(cached['library']):
+            return cached['library']
+    except (OSError, ValueError, LookupError, TypeError):
+        pass
+
+    import ctypes.util
     lib = ctypes.util.find_library('sqlcipher')
     if not lib:
         raise Error('SQLCipher library is not installed')
-    ld_preload = '{} {}'.format(os.environ.get('LD_PRELOAD', ''), lib).lstrip()
+
+    try:
+        key = _get_library_key(lib)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '{}.{}'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as file:
+            json.dump({'library': lib, 'key': key}, file)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+    return lib
+
+
+def _spawn_daemon():
+    import subprocess
+
+    with trace.span('find-library'):
+        lib = _find_sqlcipher()
+
+    # The daemon doesn't trace or profile itself, but sends its timing
+    # to clients that are tracing, and it is profiled separately.
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('MYPASS_TRACE', 'MYPASS_PROFILE')}
+    env['LD_PRELOAD'] = '{} {}'.format(os.environ.get('LD_PRELOAD', ''), lib).lstrip()
+
     process = subprocess.Popen(
         [sys.executable, '-m', 'mypass.daemon'],
-        env=dict(os.environ, LD_PRELOAD=ld_preload),
+        env=env,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         bufsize=0
     )
-    return (process.stdout, process.stdin)
+    return ClientConnection(process.stdout, process.stdin, trace.ENABLED)
+
+
+# Commands whose results only depend on the state of the database, and
+# therefore can be cached, and retried if the connection has been lost.
+READ_COMMANDS = frozenset([
+    'get-credentials',
+    'find-credentials',
+    'match-credentials',
+    'get-contexts',
+    'complete-contexts',
+    'get-usernames',
+    'search',
+])
+
+
+class Commands:
+    # Methods for the commands of the daemon, that are shared by all
+    # clients, which implement call(). Credentials are returned as
+    # lists of [username, password] pairs.
+
+    def get_credentials(self, context):
+        return self.call('get-credentials', context)
+
+    def find_credentials(self, candidates):
+        return self.call('find-credentials', candidates)
+
+    def match_credentials(self, urls):
+        return self.call('match-credentials', urls)
+
+    def get_contexts(self):
+        return self.call('get-contexts')
+
+    def complete_contexts(self, prefix, limit):
+        return self.call('complete-contexts', prefix, limit)
+
+    def get_usernames(self, context):
+        return self.call('get-usernames', context)
+
+    def search(self, query, limit=20):
+        return self.call('search', query, limit)
+
+    def store_credentials(self, context, username, password, override=False):
+        return self.call('store-credentials', context, username, password, override)
+
+    def delete_credentials(self, context, username):
+        return self.call('delete-credentials', context, username)
+
+    def delete_context(self, context):
+        return self.call('delete-context', context)
+
+    def rename_credentials(self, old_context, old_username, new_context, new_username, override=False):
+        return self.call('rename-credentials', old_context, old_username, new_context, new_username, override)
+
+    def rename_context(self, old_context, new_context, override=False):
+        return self.call('rename-context', old_context, new_context, override)
+
+    def add_context_alias(self, context, context_alias, override=False):
+        return self.call('add-context-alias', context, context_alias, override)
+
+    def batch(self, calls):
+        # Runs the given (command, args) pairs in a single transaction,
+        # either succeeding with a list of their results, or raising
+        # BatchError for the first command that failed, without changes.
+        return self.call('batch', [[command, list(args)] for command, args in calls])
 
+    def get_stats(self):
+        return self.call('stats')
+
+    def lock_database(self):
+        return self.call('shutdown')
+
+
+class Client(Commands):
+    # A single connection to the daemon, that must not be used by
+    # multiple threads at once. Use ClientPool in that case instead.
 
-class Client:
     def __init__(self, shared=True):
         self.shared = shared
-        self._pipe = None
+        self._connection = None
 
         if shared:
             try:
@@ -54,39 +181,177 @@ class Client:
         self.close()
 
     def _connect(self):
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        with trace.span('connect'), socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
             sock.connect(SOCKET)
-            self._pipe = (sock.makefile('rb', 0),
-                          sock.makefile('wb', 0))
+            self._connection = ClientConnection(sock.makefile('rb', 0),
+                                                sock.makefile('wb', 0),
+                                                trace.ENABLED)
 
     @property
     def database_locked(self):
-        return not self._pipe
+        return not self._connection
 
     def unlock_database(self, passphrase):
-        self._pipe = _spawn_daemon()
+        with trace.span('spawn-daemon'):
+            self._connection = _spawn_daemon()
         self.call('init', passphrase, self.shared)
 
     def call(self, command, *args):
-        reader, writer = self._pipe
+        with trace.span('call ' + command) as span:
+            try:
+                return self._connection.call(command, args)
+            except (BrokenPipeError, ConnectionResetError, EOFError):
+                raise ConnectionLost
+            finally:
+                span.set_server_timing(self._connection.timing)
+
+    def call_many(self, calls, window=64):
+        # Sends the given (command, args) pairs without waiting for the
+        # response to each request, and yields (index, result) pairs in the
+        # order the responses arrive, where result is an Error if failed.
         try:
-            pickle.dump((command, args), writer)
-            output = pickle.load(reader)
-        except (BrokenPipeError, EOFError):
+            yield from self._connection.call_many(calls, window)
+        except (BrokenPipeError, ConnectionResetError, EOFError):
             raise ConnectionLost
 
-        if isinstance(output, Error):
-            raise output
+    def close(self):
+        if self._connection:
+            self._connection.close()
+
+
+class ClientPool(Commands):
+    # Connections to the daemon, that are shared by multiple threads,
+    # each using one connection at a time, for up to the given number
+    # of concurrent calls. Connections that have been closed by the
+    # daemon are replaced, and calls only reading the database retried.
+    #
+    # If cache_ttl is given, results of such calls are cached for that
+    # many seconds, until any other call is made through the pool.
+    # Changes made by other clients might not be seen until then.
+    # Cached results are shared, so they must not be modified.
+
+    def __init__(self, size=4, cache_ttl=0, cache_size=1000):
+        self._cache_ttl = cache_ttl
+        self._cache_size = cache_size
+        self._cache = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_client(self):
+        with self._lock:
+            if self._closed:
+                raise Error('Client pool is closed')
+            if self._idle:
+                return self._idle.pop()
+
+        client = Client()
+        if client.database_locked:
+            raise DatabaseLocked
+        return client
 
-        return output
+    def _put_client(self, client):
+        with self._lock:
+            if not self._closed:
+                self._idle.append(client)
+                return
+        client.close()
+
+    def _call(self, command, args):
+        for retry in (False, True):
+            client = self._get_client()
+            try:
+                result = client.call(command, *args)
+            except ConnectionLost:
+                # If a connection has been lost, the daemon has likely shut
+                # down, so the other idle connections are discarded as well.
+                client.close()
+                self._close_idle()
+                if retry or command not in READ_COMMANDS:
+                    raise
+                continue
+            except Error:
+                self._put_client(client)
+                raise
+            except BaseException:
+                client.close()
+                raise
+            self._put_client(client)
+            return result
+
+    @property
+    def database_locked(self):
+        try:
+            with self._slots:
+                self._put_client(self._get_client())
+        except DatabaseLocked:
+            return True
+        return False
+
+    def unlock_database(self, passphrase):
+        with self._slots:
+            client = Client()
+            try:
+                if client.database_locked:
+                    client.unlock_database(passphrase)
+            except BaseException:
+                client.close()
+                raise
+            self._put_client(client)
+
+    def call(self, command, *args):
+        cached = self._cache_ttl > 0 and command in READ_COMMANDS
+        if cached:
+            key = json.dumps([command, args])
+            with self._lock:
+                entry = self._cache.get(key)
+                generation = self._generation
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+
+        try:
+            with self._slots:
+                result = self._call(command, args)
+        finally:
+            # Any other call might change the database, so the cache is
+            # cleared, and results of calls still in progress discarded.
+            if not cached and self._cache_ttl > 0:
+                with self._lock:
+                    self._cache.clear()
+                    self._generation += 1
+
+        if cached:
+            with self._lock:
+                if generation == self._generation:
+                    if len(self._cache) >= self._cache_size:
+                        self._cache.clear()
+                    self._cache[key] = (time.monotonic() + self._cache_ttl, result)
+        return result
+
+    def _close_idle(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for client in idle:
+            client.close()
 
     def close(self):
-        if self._pipe:
-            self._pipe[0].close()
-            self._pipe[1].close()
+        with self._lock:
+            self._closed = True
+        self._close_idle()
 
 
 def database_exists():
+    from mypass.config import get_config
+
     try:
         return os.stat(get_config('database', 'path')).st_size > 0
     except FileNotFoundError:
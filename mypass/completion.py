@@ -0,0 +1,112 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import os
+import re
+
+from mypass.client import Client
+
+# Maximum number of contexts offered for completion at once.
+COMPLETION_LIMIT = 1000
+
+# Completions are only handled here if neither the command line nor the
+# completions contain any characters that would need to be quoted, or
+# that the shell treats as word breaks, and are otherwise left to
+# argcomplete, which then parses the command line with the full parser.
+_SAFE_WORD_REGEXP = re.compile(r'[\w.@+/-]+\Z', re.ASCII)
+
+# COMP_POINT is given in bytes, so lines with any non-ASCII characters
+# are left to argcomplete. (str.isascii() requires Python 3.7.)
+_ASCII_REGEXP = re.compile(r'[\x00-\x7f]*\Z')
+
+# The completed arguments (by position) of each subcommand.
+_ARGUMENTS = {
+    'get': ['context'],
+    'add': ['context'],
+    'new': ['context'],
+    'remove': ['context', 'username'],
+    'rename': ['context', 'username'],
+    'alias': ['context'],
+}
+
+
+def _is_safe(word):
+    return bool(_SAFE_WORD_REGEXP.match(word))
+
+
+def _get_completions(words):
+    # Options, and empty words (for which argcomplete would offer
+    # options as well), aren't handled here.
+    if not all(_is_safe(word) and not word.startswith('-') for word in words):
+        return None
+
+    command, *args = words
+    arguments = _ARGUMENTS.get(command, [])
+    if len(args) > len(arguments):
+        return None
+
+    prefix = args[-1]
+    with Client() as client:
+        if client.database_locked:
+            return []
+        if arguments[len(args) - 1] == 'context':
+            completions = client.call('complete-contexts', prefix, COMPLETION_LIMIT)
+        else:
+            completions = client.call('get-usernames', args[0])
+
+    completions = [c for c in completions if c.startswith(prefix)]
+    if not all(_is_safe(c) for c in completions):
+        return None
+
+    # Like argcomplete, append a space to a single completion, so that
+    # the shell moves on to the next argument, unless it ends with a slash.
+    if len(completions) == 1 and not completions[0].endswith('/'):
+        completions[0] += ' '
+    return completions
+
+
+def complete():
+    # Only completion of the arguments of subcommands in Bash is handled
+    # here, without building the argument parser and importing argcomplete.
+    if os.environ.get('_ARGCOMPLETE') != '1' or \
+            os.environ.get('_ARGCOMPLETE_SHELL', 'bash') != 'bash' or \
+            os.environ.get('_ARGCOMPLETE_DFS'):
+        return False
+
+    if any(_is_safe(c) for c in os.environ.get('_ARGCOMPLETE_COMP_WORDBREAKS', '')):
+        return False
+
+    try:
+        line = os.environ['COMP_LINE']
+        point = int(os.environ['COMP_POINT'])
+    except (KeyError, ValueError):
+        return False
+
+    if not _ASCII_REGEXP.match(line):
+        return False
+
+    words = line[:point].split(' ')[1:]
+    if len(words) < 2 or '' in words:
+        return False
+
+    completions = _get_completions(words)
+    if completions is None:
+        return False
+
+    output = os.environ.get('_ARGCOMPLETE_IFS', '\013').join(completions).encode()
+    filename = os.environ.get('_ARGCOMPLETE_STDOUT_FILENAME')
+    if filename:
+        with open(filename, 'wb') as file:
+            file.write(output)
+    else:
+        os.write(8, output)
+    return True
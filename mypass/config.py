@@ -13,7 +13,7 @@
 import os
 import configparser
 
-from mypass import ConfigError
+from mypass import ConfigError, trace
 
 
 class _Path:
@@ -27,18 +27,48 @@ SCHEMA = {
     'daemon': {
         'timeout': 30,
         'logfile': _Path(os.path.join(DATA_DIR, 'log')),
+        'mode': 'poll',
+        'backlog': 16,
+        'max_connections': 0,
+        'read_workers': 4,
+        'cache_size': 10000,
+        'cache_warm': False,
+        'checkpoint_idle': 10,
+        'slow_request': 0,
     },
     'database': {
         'path': _Path(os.path.join(DATA_DIR, 'db')),
+        'sqlcipher_library': _Path(''),
+        # These are the default settings of SQLCipher 4 except
+        # for the key derivation algorithm which is the only one
+        # supported by SQLCipher 3. That is the best we can do
+        # while preserving compatibility with SQLCipher 3.
+        'cipher_page_size': 4096,
+        'kdf_iter': 256000,
+        'cipher_hmac_algorithm': 'HMAC_SHA1',
+        'cipher_kdf_algorithm': 'PBKDF2_HMAC_SHA1',
+        'journal_mode': 'wal',
+        'synchronous': 'full',
+        'cache_size': 8192,
+        'temp_store': 'memory',
+        'mmap_size': 0,
     },
     'password': {
         'length': 16,
+        'characters': 'lowercase uppercase digits punctuation',
+        'words': 0,
+        'wordlist': _Path(''),
     },
 }
 
 _parser = None
 
 
+def reload_config():
+    global _parser
+    _parser = None
+
+
 def get_config(section, option):
     global _parser
 
@@ -46,7 +76,8 @@ def get_config(section, option):
         _parser = configparser.ConfigParser()
         try:
             try:
-                _parser.read(os.path.join(os.path.expanduser(DATA_DIR), 'config.ini'))
+                with trace.span('read-config'):
+                    _parser.read(os.path.join(os.path.expanduser(DATA_DIR), 'config.ini'))
             except UnicodeDecodeError:
                 raise ConfigError('Unexpected encoding in config file')
             except configparser.ParsingError:
@@ -12,14 +12,33 @@
 
 import sys
 import os
-import pickle
 import socket
 import select
+import math
+import time
 import signal
+import itertools
+import threading
+import traceback
 
-from mypass import Error, SOCKET
-from mypass.config import get_config
-from mypass.db import Database, makedir_wrapper
+from mypass import Error, ConfigError, ProtocolError, BatchError, SOCKET, trace
+from mypass.cache import CredentialsCache
+from mypass.config import get_config, reload_config
+from mypass.db import Database, get_cipher_settings, makedir_wrapper
+from mypass.matching import ContextIndex
+from mypass.search import SearchIndex
+from mypass.stats import Stats
+from mypass.protocol import ServerConnection
+
+
+class Session:
+    # Imports and exports begun over a connection, which are discarded
+    # when the connection is closed, so that neither staged records are
+    # kept in memory, nor cursors left open, preventing checkpoints.
+
+    def __init__(self):
+        self.imports = set()
+        self.exports = set()
 
 
 def make_db_wrapper(method):
@@ -28,16 +47,45 @@ def make_db_wrapper(method):
     return wrapper
 
 
-class Daemon:
-    def __init__(self, fd_in, fd_out, timeout):
-        self._connections = {fd_in: (os.fdopen(fd_in, 'rb', 0, closefd=False),
-                                     os.fdopen(fd_out, 'wb', 0, closefd=False))}
-        self._poll = select.poll()
-        self._poll.register(fd_in, select.POLLIN)
+class BaseDaemon:
+    # Commands that only read from the database, and therefore can run
+    # concurrently. Note that search isn't one of them, since the search
+    # index is updated by the thread writing to the database.
+    READ_COMMANDS = frozenset([
+        'get-credentials',
+        'find-credentials',
+        'match-credentials',
+        'get-contexts',
+        'complete-contexts',
+        'get-usernames',
+    ])
+
+    # Commands that can be run as part of a batch.
+    BATCH_COMMANDS = frozenset([
+        'store-credentials',
+        'delete-credentials',
+        'delete-context',
+        'rename-credentials',
+        'rename-context',
+        'add-context-alias',
+    ])
+
+    def __init__(self, timeout):
         self._timeout = timeout
+        self._checkpoint_idle = get_config('daemon', 'checkpoint_idle') * 1000
         self._db = None
-        self._socket = None
+        self._contexts = None
+        self._cache = None
+        self._search = None
+        self._imports = {}
+        self._import_ids = itertools.count(1)
+        self._exports = {}
+        self._export_ids = itertools.count(1)
         self._shutdown = False
+        self._listening = False
+        self._stats = Stats({'init'} | {name[len('_handle_'):].replace('_', '-')
+                                        for name in dir(self) if name.startswith('_handle_')},
+                            get_config('daemon', 'slow_request'))
 
     def __enter__(self):
         return self
@@ -45,26 +93,210 @@ class Daemon:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
-    def _handle_init(self, passphrase, listen):
+    def _get_checkpoint_delay(self, idle):
+        # Once the daemon has been idle for a while after changes
+        # have been written to the WAL, the database is checkpointed.
+        if self._checkpoint_idle and self._db and self._db.checkpoint_pending:
+            return max(self._checkpoint_idle - idle, 0)
+        return None
+
+    def _open_database(self, passphrase):
         self._db = Database(get_config('database', 'path'), passphrase)
+        self._contexts = ContextIndex(self._db.get_contexts())
+        self._db.add_observer(self._contexts.update)
 
-        if listen:
-            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        cache_size = get_config('daemon', 'cache_size')
+        if cache_size > 0:
+            self._cache = CredentialsCache(cache_size)
+            self._db.add_observer(self._cache.update)
+
+            if get_config('daemon', 'cache_warm'):
+                threading.Thread(target=self._warm_cache, daemon=True).start()
+
+    def _warm_cache(self):
+        version = self._cache.version
+        with self._db.open_reader() as db:
+            self._cache.set_contexts(db.get_contexts(), version)
+            self._cache.warm(db.get_all_credentials(), version)
+
+    def _get_search_index(self):
+        # The index is only built when searching for the first time,
+        # and then kept up to date as contexts and usernames change.
+        if not self._search:
+            self._search = SearchIndex()
+            self._search.update([('add', context, id) for context, id in self._db.get_context_ids()],
+                                self._db.get_usernames())
+            self._db.add_observer(self._update_search_index)
+        return self._search
+
+    def _update_search_index(self, changes):
+        ids = {id for change, context, id in changes if change == 'update'}
+        self._search.update(changes, self._db.get_usernames(ids) if ids else {})
+
+    def _get_handler(self, cmd):
+        try:
+            return getattr(self, '_handle_' + cmd.replace('-', '_'))
+        except AttributeError:
+            raise ProtocolError('Unknown command: {}'.format(cmd))
+
+    def _execute(self, request, handler, args):
+        if request.trace:
+            trace.start_collecting()
+
+        start = time.perf_counter()
+        try:
+            with trace.span('execute'):
+                return handler(*args)
+        except TypeError:
+            # Arguments of the wrong number or type must not crash the
+            # daemon, but are logged, in case it's a bug of the daemon.
+            traceback.print_exc()
+            raise ProtocolError('Invalid arguments')
+        finally:
+            request.execute = time.perf_counter() - start
+            if request.trace:
+                request.spans = trace.stop_collecting()
+
+    def _get_server_timing(self, request):
+        if request.trace:
+            return trace.get_server_timing(request.start, request.spans)
+        return None
 
+    def _update_session(self, session, cmd, args, result):
+        if cmd == 'begin-import':
+            session.imports.add(result)
+        elif cmd in ('commit-import', 'abort-import'):
+            session.imports.discard(args[0])
+        elif cmd == 'begin-export':
+            session.exports.add(result)
+        elif cmd == 'end-export':
+            session.exports.discard(args[0])
+
+    def _end_session(self, session):
+        for import_id in session.imports:
+            self._imports.pop(import_id, None)
+        for export_id in session.exports:
+            self._handle_end_export(export_id)
+
+    def _handle_shutdown(self):
+        self._shutdown = True
+
+        # The socket is removed right away, so that clients connecting after
+        # the response fail, rather than being reset when the daemon exits.
+        if self._listening:
             try:
                 os.unlink(SOCKET)
             except FileNotFoundError:
                 pass
 
-            self._socket.bind(SOCKET)
-            self._socket.listen(5)
-            self._poll.register(self._socket, select.POLLIN)
+    def _handle_stats(self):
+        return self._stats.get_stats()
 
-    def _handle_shutdown(self):
-        self._shutdown = True
+    def _handle_get_credentials(self, context):
+        if not self._cache:
+            with trace.span('query'):
+                return self._db.get_credentials(context)
+
+        credentials = self._cache.get_credentials(context)
+        if credentials is None:
+            version = self._cache.version
+            with trace.span('query'):
+                id, credentials = self._db.get_credentials_with_id(context)
+            self._cache.add_credentials(context, id, credentials, version)
+        return credentials
+
+    def _handle_get_contexts(self):
+        if not self._cache:
+            with trace.span('query'):
+                return self._db.get_contexts()
+
+        contexts = self._cache.get_contexts()
+        if contexts is None:
+            version = self._cache.version
+            with trace.span('query'):
+                contexts = self._db.get_contexts()
+            self._cache.set_contexts(contexts, version)
+        return contexts
+
+    def _handle_complete_contexts(self, prefix, limit):
+        return self._db.complete_contexts(prefix, limit)
+
+    def _handle_get_usernames(self, context):
+        if self._cache:
+            credentials = self._cache.get_credentials(context)
+            if credentials is not None:
+                return [username for username, _ in credentials]
+        return self._db.get_context_usernames(context)
+
+    def _handle_match_credentials(self, urls):
+        results = []
+        for url in urls:
+            contexts = self._contexts.match(url)
+            results.append(self._handle_get_credentials(contexts[0]) if contexts else None)
+        return results
+
+    def _handle_search(self, query, limit):
+        return self._get_search_index().search(query, limit)
+
+    # Records to import are sent in chunks, and staged until
+    # the import is committed, and then written all at once.
+
+    def _get_import(self, import_id):
+        try:
+            return self._imports[import_id]
+        except KeyError:
+            raise Error('Unknown import')
+
+    def _handle_begin_import(self):
+        import_id = next(self._import_ids)
+        self._imports[import_id] = []
+        return import_id
+
+    def _handle_add_import_records(self, import_id, records):
+        staged = self._get_import(import_id)
+
+        for record in records:
+            if not (isinstance(record, list) and len(record) == 4 and
+                    all(isinstance(field, str) for field in record[:3]) and
+                    isinstance(record[3], list) and
+                    all(isinstance(alias, str) for alias in record[3])):
+                raise ProtocolError('Invalid record')
+            staged.append(tuple(record))
 
-    _handle_get_credentials = make_db_wrapper('get_credentials')
-    _handle_get_contexts = make_db_wrapper('get_contexts')
+        return len(staged)
+
+    def _handle_commit_import(self, import_id, on_conflict, dry_run):
+        if on_conflict not in ('fail', 'skip', 'override'):
+            raise ProtocolError('Invalid conflict policy')
+
+        records = self._get_import(import_id)
+        del self._imports[import_id]
+        return self._db.import_credentials(records, on_conflict, dry_run)
+
+    def _handle_abort_import(self, import_id):
+        self._imports.pop(import_id, None)
+
+    # Exported records are read from a cursor in chunks as requested,
+    # so that they don't have to be held in memory all at once.
+
+    def _handle_begin_export(self, compact):
+        export_id = next(self._export_ids)
+        self._exports[export_id] = self._db.export_credentials(compact)
+        return export_id
+
+    def _handle_get_export_records(self, export_id, count):
+        try:
+            records = self._exports[export_id]
+        except KeyError:
+            raise Error('Unknown export')
+        return list(itertools.islice(records, count))
+
+    def _handle_end_export(self, export_id):
+        records = self._exports.pop(export_id, None)
+        if records:
+            records.close()
+
+    _handle_find_credentials = make_db_wrapper('find_credentials')
     _handle_store_credentials = make_db_wrapper('store_credentials')
     _handle_delete_credentials = make_db_wrapper('delete_credentials')
     _handle_delete_context = make_db_wrapper('delete_context')
@@ -73,49 +305,154 @@ class Daemon:
     _handle_change_passphrase = make_db_wrapper('change_passphrase')
     _handle_add_context_alias = make_db_wrapper('add_context_alias')
 
-    def _serve_request(self, reader, writer):
-        cmd, args = pickle.load(reader)
+    def _handle_batch(self, calls):
+        for call in calls:
+            if not (isinstance(call, (list, tuple)) and len(call) == 2 and
+                    call[0] in self.BATCH_COMMANDS and isinstance(call[1], (list, tuple))):
+                raise ProtocolError('Invalid batch')
+
+        # All commands are run in a single transaction, so that either
+        # all or none of the changes are committed, at once.
+        results = []
+        with self._db.transaction():
+            for index, (cmd, args) in enumerate(calls):
+                try:
+                    results.append(self._get_handler(cmd)(*args))
+                except Error as e:
+                    raise BatchError(index, str(e))
+        return results
+
+    def _handle_reencrypt(self):
+        # The config is read again, since the cipher settings
+        # have likely been changed after the daemon started.
+        reload_config()
+        self._db.reencrypt(get_cipher_settings())
+
+    def close(self):
+        if self._db:
+            self._db.close()
+
+
+class Daemon(BaseDaemon):
+    def __init__(self, fd_in, fd_out, timeout):
+        super().__init__(timeout)
+        self._connections = {fd_in: ServerConnection(os.fdopen(fd_in, 'rb', 0, closefd=False),
+                                                     os.fdopen(fd_out, 'wb', 0, closefd=False))}
+        self._sessions = {fd_in: Session()}
+        self._poll = select.poll()
+        self._poll.register(fd_in, select.POLLIN)
+        self._stats.connection_opened()
+        self._socket = None
+        self._max_connections = 0
+        self._accepting = True
+
+    def _handle_init(self, passphrase, listen):
+        self._open_database(passphrase)
+
+        if listen:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                os.unlink(SOCKET)
+            except FileNotFoundError:
+                pass
+
+            self._socket.bind(SOCKET)
+            self._socket.listen(get_config('daemon', 'backlog'))
+            self._listening = True
+            self._poll.register(self._socket, select.POLLIN)
+            self._max_connections = get_config('daemon', 'max_connections')
+
+    def _serve_request(self, connection, session):
+        id, cmd, args = connection.read_request()
+        request = self._stats.begin(cmd, connection.trace)
 
         try:
-            response = getattr(self, '_handle_' + cmd.replace('-', '_'))(*args)
+            response = self._execute(request, self._get_handler(cmd), args)
         except Error as e:
-            response = e
+            request.failed = True
+            start = time.perf_counter()
+            connection.write_error(id, e, self._get_server_timing(request))
+        else:
+            self._update_session(session, cmd, args, response)
+            start = time.perf_counter()
+            connection.write_response(id, response, self._get_server_timing(request))
+
+        request.serialize = time.perf_counter() - start
+        self._stats.end(request)
+
+    def _serve_connection(self, connection, session):
+        # Clients might send multiple requests at once, so we process all
+        # requests that have been buffered before waiting for more data.
+        try:
+            self._serve_request(connection, session)
+            while connection.has_buffered_request():
+                self._serve_request(connection, session)
+        finally:
+            connection.flush()
 
-        pickle.dump(response, writer)
+    def _accept_connections(self):
+        # Once the limit of connections is reached, we stop accepting
+        # new connections, so that further clients are queued by the
+        # kernel, according to the backlog, until a connection is closed.
+        accept = not self._max_connections or len(self._connections) < self._max_connections
+        if accept != self._accepting:
+            self._poll.modify(self._socket, select.POLLIN if accept else 0)
+            self._accepting = accept
 
     def run(self):
+        last_activity = time.monotonic()
+
         while True:
-            events = self._poll.poll(self._timeout)
+            idle = (time.monotonic() - last_activity) * 1000
+            timeout = max(self._timeout - idle, 0)
+            checkpoint_delay = self._get_checkpoint_delay(idle)
+            if checkpoint_delay is not None:
+                timeout = min(timeout, checkpoint_delay)
+
+            events = self._poll.poll(math.ceil(timeout))
+            if not events:
+                idle = (time.monotonic() - last_activity) * 1000
+                if self._get_checkpoint_delay(idle) == 0:
+                    self._db.checkpoint()
+                if idle >= self._timeout:
+                    break
+                continue
 
+            last_activity = time.monotonic()
             for fd, _ in events:
                 if self._socket and fd == self._socket.fileno():
                     with self._socket.accept()[0] as conn:
                         self._poll.register(conn, select.POLLIN)
-                        self._connections[conn.fileno()] = (
+                        self._connections[conn.fileno()] = ServerConnection(
                             conn.makefile('rb', 0),
                             conn.makefile('wb', 0)
                         )
+                        self._sessions[conn.fileno()] = Session()
+                        self._stats.connection_opened()
                 else:
-                    reader, writer = self._connections[fd]
+                    connection = self._connections[fd]
                     try:
-                        self._serve_request(reader, writer)
-                    except EOFError:
+                        self._serve_connection(connection, self._sessions[fd])
+                    except (EOFError, ProtocolError, BrokenPipeError, ConnectionResetError):
                         self._poll.unregister(fd)
                         del self._connections[fd]
-                        reader.close()
-                        writer.close()
+                        self._end_session(self._sessions.pop(fd))
+                        connection.close()
+                        self._stats.connection_closed()
 
-            if not events or self._shutdown or (not self._socket and not self._connections):
+            if self._socket:
+                self._accept_connections()
+
+            if self._shutdown or (not self._socket and not self._connections):
                 break
 
     def close(self):
-        for (reader, writer) in self._connections.values():
-            reader.close()
-            writer.close()
+        for connection in self._connections.values():
+            connection.close()
         if self._socket:
             self._socket.close()
-        if self._db:
-            self._db.close()
+        super().close()
 
 
 if __name__ == '__main__':
@@ -125,6 +462,9 @@ if __name__ == '__main__':
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
+        if os.environ.get('MYPASS_DAEMON_PROFILE'):
+            trace.start_profiling(os.environ['MYPASS_DAEMON_PROFILE'])
+
         log_fd = makedir_wrapper(lambda fn: os.open(fn, os.O_WRONLY |
                                                         os.O_TRUNC |
                                                         os.O_CREAT, 0o666),
@@ -132,9 +472,18 @@ if __name__ == '__main__':
         os.dup2(log_fd, sys.stderr.fileno())
         os.close(log_fd)
 
-        with Daemon(sys.stdin.fileno(),
-                    sys.stdout.fileno(),
-                    get_config('daemon', 'timeout') * 60000) as daemon:
+        mode = get_config('daemon', 'mode')
+        if mode == 'asyncio':
+            from mypass.asyncdaemon import AsyncDaemon as cls
+        elif mode == 'poll':
+            cls = Daemon
+        else:
+            raise ConfigError('Invalid value for option {!r} in section '
+                              '{!r} in config file'.format('mode', 'daemon'))
+
+        with cls(sys.stdin.fileno(),
+                 sys.stdout.fileno(),
+                 get_config('daemon', 'timeout') * 60000) as daemon:
             daemon.run()
     except Error as e:
         print(e, file=sys.stderr)
@@ -11,10 +11,68 @@
 # for more details.
 
 import os
+import operator
+import itertools
+import contextlib
+import urllib.parse
 
 import sqlite3
 
-from mypass import DatabaseError, CredentialsDoNotExist, CredentialsAlreadytExist
+from mypass import ConfigError, DatabaseError, CredentialsDoNotExist, CredentialsAlreadytExist, trace
+from mypass.config import SCHEMA, get_config
+
+# The maximum number of host parameters in a single SQL statement
+# supported by SQLite versions before 3.32.
+MAX_VARIABLES = 999
+
+CIPHER_SETTINGS = ['cipher_page_size', 'kdf_iter', 'cipher_hmac_algorithm', 'cipher_kdf_algorithm']
+STORAGE_SETTINGS = ['journal_mode', 'synchronous', 'cache_size', 'temp_store', 'mmap_size']
+
+_CHOICES = {
+    'cipher_hmac_algorithm': ['HMAC_SHA1', 'HMAC_SHA256', 'HMAC_SHA512'],
+    'cipher_kdf_algorithm': ['PBKDF2_HMAC_SHA1', 'PBKDF2_HMAC_SHA256', 'PBKDF2_HMAC_SHA512'],
+    'journal_mode': ['DELETE', 'TRUNCATE', 'PERSIST', 'WAL'],
+    'synchronous': ['OFF', 'NORMAL', 'FULL', 'EXTRA'],
+    'temp_store': ['DEFAULT', 'FILE', 'MEMORY'],
+}
+
+
+# Both tables are clustered by their primary key (WITHOUT ROWID), so that
+# looking up credentials by context, and their usernames by id, are served
+# from the tables and indexes alone, as secondary indexes implicitly include
+# the columns of the primary key.
+_SCHEMA = [
+    '''CREATE TABLE credentials (
+           id INTEGER NOT NULL,
+           username TEXT NOT NULL,
+           password TEXT NOT NULL,
+           PRIMARY KEY (id, username)
+       ) WITHOUT ROWID''',
+    '''CREATE TABLE contexts (
+           id INTEGER NOT NULL,
+           context TEXT COLLATE NOCASE PRIMARY KEY
+       ) WITHOUT ROWID''',
+    'CREATE INDEX credentials_id_index ON credentials(id)',
+    'CREATE INDEX contexts_id_index ON contexts(id)',
+]
+
+# The statements upgrading the schema to each version, in order, after the
+# version it was created with (stored as user_version). New databases are
+# created with the schema above, which must be kept in sync.
+_MIGRATIONS = [
+    # Databases created before schema versions were introduced have
+    # user_version 0, but the same schema as version 1.
+    [
+        'CREATE INDEX IF NOT EXISTS credentials_id_index ON credentials(id)',
+        'CREATE INDEX IF NOT EXISTS contexts_id_index ON contexts(id)',
+    ],
+]
+
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+
+class _Rollback(Exception):
+    pass
 
 
 def makedir_wrapper(func, filename, exc=FileNotFoundError):
@@ -29,58 +87,180 @@ def _execute_pragma_with_arg(cursor, pragma, arg):
     cursor.execute("PRAGMA {} = '{}'".format(pragma, arg.replace("'", "''")))
 
 
-def _connect(filename, passphrase, migrate):
-    db = makedir_wrapper(sqlite3.connect, filename, sqlite3.OperationalError)
+def _open(filename, readonly):
+    # Connections might be closed by a different thread than the one
+    # using them, when the daemon serves requests from a thread pool.
+    if readonly:
+        return sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(filename)),
+                               uri=True, check_same_thread=False)
+    return makedir_wrapper(lambda filename: sqlite3.connect(filename, check_same_thread=False),
+                           filename, sqlite3.OperationalError)
 
-    try:
-        cursor = db.cursor()
-        cursor.execute('PRAGMA cipher_version')
-        if not cursor.fetchone():
-            raise DatabaseError('SQLCipher unavailable')
-
-        _execute_pragma_with_arg(cursor, 'key', passphrase)
-
-        # These are the default settings of SQLCipher 4 except
-        # for the key derivation algorithm which is the only one
-        # supported by SQLCipher 3. That is the best we can do
-        # while preserving compatibility with SQLCipher 3.
-        cursor.executescript(
-            'PRAGMA cipher_page_size = 4096;'
-            'PRAGMA kdf_iter = 256000;'
-            'PRAGMA cipher_hmac_algorithm = HMAC_SHA1;'
-            'PRAGMA cipher_kdf_algorithm = PBKDF2_HMAC_SHA1;'
-        )
+
+def _get_settings(options, default):
+    settings = {}
+
+    for option in options:
+        if default:
+            value = SCHEMA['database'][option]
+        else:
+            value = get_config('database', option)
+
+        if option in _CHOICES:
+            value = value.upper()
+            valid = value in _CHOICES[option]
+        elif option == 'cipher_page_size':
+            valid = 512 <= value <= 65536 and value & (value - 1) == 0
+        elif option == 'mmap_size':
+            valid = value >= 0
+        else:
+            valid = value > 0
+
+        if not valid:
+            raise ConfigError('Invalid value for option {!r} in section '
+                              "'database' in config file".format(option))
+        settings[option] = value
+
+    return settings
+
+
+def get_cipher_settings(default=False):
+    return _get_settings(CIPHER_SETTINGS, default)
+
+
+def _set_cipher_settings(cursor, settings, schema=None):
+    prefix = schema + '.' if schema else ''
+    cursor.executescript(''.join('PRAGMA {}{} = {};'.format(prefix, option, settings[option])
+                                 for option in CIPHER_SETTINGS))
+
+
+def _set_storage_settings(cursor, settings, readonly):
+    for option in STORAGE_SETTINGS:
+        value = settings[option]
+
+        # The journal mode is persisted in the database,
+        # and can only be changed by the writing connection.
+        if option == 'journal_mode' and readonly:
+            continue
+
+        # A negative cache size is interpreted as KiB, rather than pages.
+        if option == 'cache_size':
+            value = -value
+
+        cursor.execute('PRAGMA {} = {}'.format(option, value))
+
+
+def _connect(filename, passphrase, migrate, readonly=False, cipher_settings=None):
+    # Unless the settings are given, the configured settings are tried
+    # first, then the default settings, so that databases created before
+    # the settings have been changed can still be opened and re-encrypted.
+    if cipher_settings:
+        candidates = [cipher_settings]
+    else:
+        candidates = [get_cipher_settings()]
+        default_settings = get_cipher_settings(default=True)
+        if default_settings != candidates[0]:
+            candidates.append(default_settings)
+
+    for settings in candidates:
+        db = _open(filename, readonly)
 
         try:
-            cursor.execute('SELECT COUNT(*) FROM sqlite_master')
-        except sqlite3.DatabaseError:
-            if migrate:
+            cursor = db.cursor()
+            cursor.execute('PRAGMA cipher_version')
+            if not cursor.fetchone():
+                raise DatabaseError('SQLCipher unavailable')
+
+            _execute_pragma_with_arg(cursor, 'key', passphrase)
+            _set_cipher_settings(cursor, settings)
+
+            # The key is derived from the passphrase when reading the first page.
+            try:
+                with trace.span('derive-key'):
+                    cursor.execute('SELECT COUNT(*) FROM sqlite_master')
+            except sqlite3.DatabaseError:
                 db.close()
-                from mypass.migration import update_from_legacy_db
-                if update_from_legacy_db(filename, passphrase):
-                    return _connect(filename, passphrase, migrate=False)
-            raise DatabaseError('Wrong passphrase or broken database')
-
-        if cursor.fetchone()[0] == 0:
-            cursor.executescript(
-                '''CREATE TABLE credentials (
-                       id INTEGER NOT NULL,
-                       username TEXT NOT NULL,
-                       password TEXT NOT NULL,
-                       PRIMARY KEY (id, username)
-                   ) WITHOUT ROWID;
-                   CREATE TABLE contexts (
-                       id INTEGER NOT NULL,
-                       context TEXT COLLATE NOCASE PRIMARY KEY
-                   ) WITHOUT ROWID;
-                   CREATE INDEX credentials_id_index ON credentials(id);
-                   CREATE INDEX contexts_id_index ON contexts(id);'''
-            )
-    except:
-        db.close()
-        raise
-
-    return db
+                continue
+
+            if not readonly:
+                if cursor.fetchone()[0] == 0:
+                    _upgrade_schema(db, None)
+                else:
+                    _upgrade_schema(db, db.execute('PRAGMA user_version').fetchone()[0])
+
+            _set_storage_settings(cursor, _get_settings(STORAGE_SETTINGS, False), readonly)
+        except:
+            db.close()
+            raise
+
+        return db, settings
+
+    if migrate:
+        from mypass.migration import update_from_legacy_db
+        if update_from_legacy_db(filename, passphrase):
+            return _connect(filename, passphrase, migrate=False)
+    raise DatabaseError('Wrong passphrase or broken database')
+
+
+def _upgrade_schema(db, version):
+    # The schema is created, or migrated to the current version, when
+    # unlocking the database, in a single transaction, so that it is
+    # never left at a version in between.
+    if version == SCHEMA_VERSION:
+        return
+    if version is not None and version > SCHEMA_VERSION:
+        raise DatabaseError('Database has been created by a newer version of mypass')
+
+    with trace.span('upgrade-schema'):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            if version is None:
+                statements = _SCHEMA
+            else:
+                statements = itertools.chain.from_iterable(_MIGRATIONS[version:])
+            for statement in statements:
+                db.execute(statement)
+            db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+
+def _create_change_triggers(db, callback):
+    db.create_function('mypass_changed', 3, callback)
+
+    # Recursive triggers must be enabled, so that delete triggers
+    # also fire when rows are removed by the REPLACE conflict resolution.
+    db.executescript(
+        '''PRAGMA recursive_triggers = ON;
+           CREATE TEMP TRIGGER contexts_insert AFTER INSERT ON main.contexts
+           BEGIN
+               SELECT mypass_changed('add', NEW.context, NEW.id);
+           END;
+           CREATE TEMP TRIGGER contexts_delete AFTER DELETE ON main.contexts
+           BEGIN
+               SELECT mypass_changed('remove', OLD.context, OLD.id);
+           END;
+           CREATE TEMP TRIGGER contexts_update AFTER UPDATE ON main.contexts
+           BEGIN
+               SELECT mypass_changed('remove', OLD.context, OLD.id);
+               SELECT mypass_changed('add', NEW.context, NEW.id);
+           END;
+           CREATE TEMP TRIGGER credentials_insert AFTER INSERT ON main.credentials
+           BEGIN
+               SELECT mypass_changed('update', NULL, NEW.id);
+           END;
+           CREATE TEMP TRIGGER credentials_delete AFTER DELETE ON main.credentials
+           BEGIN
+               SELECT mypass_changed('update', NULL, OLD.id);
+           END;
+           CREATE TEMP TRIGGER credentials_update AFTER UPDATE ON main.credentials
+           BEGIN
+               SELECT mypass_changed('update', NULL, OLD.id);
+               SELECT mypass_changed('update', NULL, NEW.id);
+           END;'''
+    )
 
 
 def _get_id_or_create_context(cursor, context):
@@ -118,32 +298,50 @@ def _clear_orphans(cursor, target_table, updated_table, id):
                        'WHERE id = ?'.format(target_table), (id,))
 
 
-def _rename_or_alias_context(sql, db, old_context, new_context, override):
-    with db:
-        cursor = db.cursor()
+def _rename_or_alias_context(sql, cursor, old_context, new_context, override):
+    result = None
+    if override:
+        cursor.execute('SELECT id FROM contexts '
+                       'WHERE context = ?', (new_context,))
+        result = cursor.fetchone()
 
-        result = None
-        if override:
-            cursor.execute('SELECT id FROM contexts '
-                           'WHERE context = ?', (new_context,))
-            result = cursor.fetchone()
-
-        try:
-            cursor.execute(sql.format(' OR REPLACE' if override else ''),
-                           (new_context, old_context))
-        except sqlite3.IntegrityError:
-            raise CredentialsAlreadytExist
+    try:
+        cursor.execute(sql.format(' OR REPLACE' if override else ''),
+                       (new_context, old_context))
+    except sqlite3.IntegrityError:
+        raise CredentialsAlreadytExist
 
-        if cursor.rowcount == 0:
-            raise CredentialsDoNotExist
+    if cursor.rowcount == 0:
+        raise CredentialsDoNotExist
 
-        if result:
-            _clear_orphans(cursor, 'credentials', 'contexts', result[0])
+    if result:
+        _clear_orphans(cursor, 'credentials', 'contexts', result[0])
 
 
 class Database:
-    def __init__(self, filename, passphrase):
-        self._db = _connect(filename, passphrase, migrate=True)
+    def __init__(self, filename, passphrase, readonly=False, cipher_settings=None):
+        self._db, self._cipher_settings = _connect(filename, passphrase,
+                                                   migrate=not readonly,
+                                                   readonly=readonly,
+                                                   cipher_settings=cipher_settings)
+        self._filename = filename
+        self._passphrase = passphrase
+        self._readonly = readonly
+        self._observers = []
+        self._changes = []
+        self._in_transaction = False
+        self._wal = False
+        self.checkpoint_pending = False
+        self._init_connection()
+
+    def _init_connection(self):
+        if not self._readonly:
+            try:
+                _create_change_triggers(self._db, lambda *change: self._changes.append(change))
+                self._wal = self._db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            except:
+                self._db.close()
+                raise
 
     def __enter__(self):
         return self
@@ -151,24 +349,138 @@ class Database:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Transactions can be nested, e.g. to run multiple commands at once,
+        # in which case changes are only committed once the outermost
+        # transaction completes, and rolled back entirely on any error.
+        if self._in_transaction:
+            yield self._db.cursor()
+            return
+
+        self._in_transaction = True
+        try:
+            with self._db:
+                yield self._db.cursor()
+        except:
+            del self._changes[:]
+            raise
+        finally:
+            self._in_transaction = False
+
+        # Observers are notified about added and removed contexts, and
+        # the ids of updated credentials, once the transaction has been
+        # committed successfully.
+        changes = self._changes
+        self._changes = []
+        self.checkpoint_pending = self._wal
+        for observer in self._observers:
+            observer(changes)
+
+    def transaction(self):
+        return self._transaction()
+
     def get_credentials(self, context):
-        credentials = list(self._db.execute('''SELECT username, password
-                                                 FROM credentials
-                                           INNER JOIN contexts USING (id)
-                                                WHERE context = ?
-                                             ORDER BY username''', (context,)))
-        if not credentials:
+        return self.get_credentials_with_id(context)[1]
+
+    def get_credentials_with_id(self, context):
+        rows = list(self._db.execute('''SELECT id, username, password
+                                          FROM credentials
+                                    INNER JOIN contexts USING (id)
+                                         WHERE context = ?
+                                      ORDER BY username''', (context,)))
+        if not rows:
             raise CredentialsDoNotExist
-        return credentials
+        return rows[0][0], [(username, password) for _, username, password in rows]
+
+    def get_all_credentials(self):
+        return self._db.execute('''SELECT context, id, username, password
+                                     FROM contexts
+                               INNER JOIN credentials USING (id)
+                                 ORDER BY id, username''')
+
+    def find_credentials(self, candidates):
+        contexts = list({context.lower() for group in candidates for context in group})
+        found = {}
+
+        for i in range(0, len(contexts), MAX_VARIABLES):
+            chunk = contexts[i:i + MAX_VARIABLES]
+            for context, username, password in self._db.execute(
+                    '''SELECT context, username, password
+                         FROM credentials
+                   INNER JOIN contexts USING (id)
+                        WHERE context IN ({})
+                     ORDER BY username'''.format(', '.join('?' * len(chunk))), chunk):
+                found.setdefault(context.lower(), []).append((username, password))
+
+        results = []
+        for group in candidates:
+            for context in group:
+                credentials = found.get(context.lower())
+                if credentials:
+                    break
+            else:
+                credentials = None
+            results.append(credentials)
+        return results
 
     def get_contexts(self):
         return [ctx for ctx, in self._db.execute('''SELECT context
                                                       FROM contexts
                                                   ORDER BY context''')]
 
+    def complete_contexts(self, prefix, limit):
+        # Contexts are looked up in the (case-insensitive) index, but only
+        # those starting with the prefix exactly are returned, as shells
+        # complete case-sensitively.
+        sql = '''SELECT context
+                   FROM contexts
+                  WHERE context >= ? AND context < ?
+                    AND substr(context, 1, ?) = ? COLLATE BINARY
+               ORDER BY context {} LIMIT ?'''
+        args = (prefix, prefix + '\U0010ffff', len(prefix), prefix)
+        contexts = [ctx for ctx, in self._db.execute(sql.format('ASC'), args + (limit + 1,))]
+
+        # If there are more contexts than the limit, the last one is returned
+        # instead, so that the shell doesn't complete beyond the common prefix.
+        if len(contexts) > limit:
+            contexts[limit - 1:] = [ctx for ctx, in self._db.execute(sql.format('DESC'), args + (1,))]
+        return contexts
+
+    def get_context_usernames(self, context):
+        return [username for username, in self._db.execute('''SELECT username
+                                                                FROM credentials
+                                                          INNER JOIN contexts USING (id)
+                                                               WHERE context = ?
+                                                            ORDER BY username''', (context,))]
+
+    def get_context_ids(self):
+        return list(self._db.execute('SELECT context, id FROM contexts'))
+
+    def get_usernames(self, ids=None):
+        if ids is None:
+            usernames = {}
+            for id, username in self._db.execute('SELECT id, username FROM credentials'):
+                usernames.setdefault(id, []).append(username)
+            return usernames
+
+        ids = list(ids)
+        usernames = {id: [] for id in ids}
+
+        for i in range(0, len(ids), MAX_VARIABLES):
+            chunk = ids[i:i + MAX_VARIABLES]
+            for id, username in self._db.execute(
+                    'SELECT id, username FROM credentials '
+                    'WHERE id IN ({})'.format(', '.join('?' * len(chunk))), chunk):
+                usernames[id].append(username)
+
+        return usernames
+
     def store_credentials(self, context, username, password, override=False):
-        with self._db:
-            cursor = self._db.cursor()
+        with self._transaction() as cursor:
             id = _get_id_or_create_context(cursor, context)
 
             try:
@@ -181,16 +493,14 @@ class Database:
                 raise CredentialsAlreadytExist
 
     def delete_credentials(self, context, username):
-        with self._db:
-            cursor = self._db.cursor()
+        with self._transaction() as cursor:
             id = _get_id(cursor, context, username)
             cursor.execute('DELETE FROM credentials '
                            'WHERE id = ? AND username = ?''', (id, username))
             _clear_orphans(cursor, 'contexts', 'credentials', id)
 
     def delete_context(self, context):
-        with self._db:
-            cursor = self._db.cursor()
+        with self._transaction() as cursor:
             cursor.execute('SELECT id FROM contexts '
                            'WHERE context = ?', (context,))
             result = cursor.fetchone()
@@ -202,8 +512,7 @@ class Database:
             _clear_orphans(cursor, 'credentials', 'contexts', id)
 
     def rename_credentials(self, old_context, old_username, new_context, new_username, override=False):
-        with self._db:
-            cursor = self._db.cursor()
+        with self._transaction() as cursor:
             old_id = _get_id(cursor, old_context, old_username)
             new_id = _get_id_or_create_context(cursor, new_context)
 
@@ -222,20 +531,156 @@ class Database:
             _clear_orphans(cursor, 'contexts', 'credentials', old_id)
 
     def rename_context(self, old_context, new_context, override=False):
-        _rename_or_alias_context('''UPDATE{} contexts
-                                         SET context = ?
-                                       WHERE context = ?''',
-                                 self._db, old_context, new_context, override)
+        with self._transaction() as cursor:
+            _rename_or_alias_context('''UPDATE{} contexts
+                                             SET context = ?
+                                           WHERE context = ?''',
+                                     cursor, old_context, new_context, override)
 
     def add_context_alias(self, context, context_alias, override=True):
-        _rename_or_alias_context('''INSERT{} INTO contexts (id, context)
+        with self._transaction() as cursor:
+            _rename_or_alias_context('''INSERT{} INTO contexts (id, context)
+                                               SELECT id, ?
+                                                 FROM contexts
+                                                WHERE context = ?''',
+                                     cursor, context, context_alias, override)
+
+    def import_credentials(self, records, on_conflict='fail', dry_run=False):
+        report = {'added': 0, 'updated': 0, 'skipped': 0}
+
+        try:
+            with self._transaction() as cursor:
+                cursor.execute('''SELECT MAX((SELECT IFNULL(MAX(id), 0) FROM credentials),
+                                             (SELECT IFNULL(MAX(id), 0) FROM contexts))''')
+                next_id = cursor.fetchone()[0] + 1
+
+                # Contexts that already exist are ignored, like contexts
+                # only differing in case, that are imported more than once.
+                cursor.executemany('INSERT OR IGNORE INTO contexts (id, context) VALUES (?, ?)',
+                                   zip(itertools.count(next_id),
+                                       dict.fromkeys(record[0] for record in records)))
+                cursor.executemany('''INSERT OR IGNORE INTO contexts (id, context)
                                            SELECT id, ?
                                              FROM contexts
                                             WHERE context = ?''',
-                                 self._db, context, context_alias, override)
+                                   ((alias, record[0]) for record in records for alias in record[3]))
+
+                cursor.executemany('''INSERT OR IGNORE INTO credentials (id, username, password)
+                                           SELECT id, ?, ?
+                                             FROM contexts
+                                            WHERE context = ?''',
+                                   ((username, password, context) for context, username, password, _ in records))
+                report['added'] = cursor.rowcount
+
+                if on_conflict == 'override':
+                    cursor.executemany('''UPDATE credentials
+                                             SET password = ?
+                                           WHERE id = (SELECT id FROM contexts WHERE context = ?)
+                                             AND username = ?
+                                             AND password != ?''',
+                                       ((password, context, username, password)
+                                        for context, username, password, _ in records))
+                    report['updated'] = cursor.rowcount
+
+                report['skipped'] = len(records) - report['added'] - report['updated']
+                if report['skipped'] and on_conflict == 'fail':
+                    raise CredentialsAlreadytExist
+
+                if dry_run:
+                    raise _Rollback
+        except _Rollback:
+            pass
+
+        return report
+
+    def export_credentials(self, compact=False):
+        try:
+            if not compact:
+                for row in self._db.execute('''SELECT context, username, password
+                                                 FROM contexts
+                                           INNER JOIN credentials USING (id)
+                                             ORDER BY context, username'''):
+                    yield list(row)
+                return
+
+            # Contexts and credentials are merged as they are read, both
+            # ordered by id, so that only a single group is held in memory.
+            contexts = self._db.execute('SELECT id, context FROM contexts ORDER BY id, context')
+            pending = contexts.fetchone()
+
+            for id, credentials in itertools.groupby(
+                    self._db.execute('''SELECT id, username, password
+                                         FROM credentials
+                                     ORDER BY id, username'''),
+                    operator.itemgetter(0)):
+                group = []
+                while pending and pending[0] <= id:
+                    if pending[0] == id:
+                        group.append(pending[1])
+                    pending = contexts.fetchone()
+
+                if group:
+                    for _, username, password in credentials:
+                        yield [group[0], username, password, group[1:]]
+        except sqlite3.Error as e:
+            raise DatabaseError('Export failed: {}'.format(e))
+
+    def open_reader(self):
+        return Database(self._filename, self._passphrase, readonly=True,
+                        cipher_settings=self._cipher_settings)
 
     def change_passphrase(self, passphrase):
         _execute_pragma_with_arg(self._db, 'rekey', passphrase)
+        self._passphrase = passphrase
+
+    def reencrypt(self, cipher_settings):
+        # The database is exported into a new file, encrypted using the
+        # given settings, which then replaces the original file.
+        tempfilename = self._filename + '.reencrypt'
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tempfilename)
+
+        try:
+            cursor = self._db.cursor()
+            cursor.execute('ATTACH DATABASE ? AS reencrypted KEY ?', (tempfilename, self._passphrase))
+            try:
+                _set_cipher_settings(cursor, cipher_settings, 'reencrypted')
+                cursor.execute("SELECT sqlcipher_export('reencrypted')")
+                cursor.execute('PRAGMA main.user_version')
+                cursor.execute('PRAGMA reencrypted.user_version = {:d}'.format(cursor.fetchone()[0]))
+            finally:
+                cursor.execute('DETACH DATABASE reencrypted')
+        except sqlite3.Error as e:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tempfilename)
+            raise DatabaseError('Re-encryption failed: {}'.format(e))
+
+        # The connection is closed before the file is replaced, so that
+        # the WAL belonging to the original file is checkpointed and removed.
+        # Any read-only connections must have been closed before as well.
+        self._db.close()
+        try:
+            os.replace(tempfilename, self._filename)
+        except:
+            os.unlink(tempfilename)
+            cipher_settings = self._cipher_settings
+            raise
+        finally:
+            self._db, self._cipher_settings = _connect(self._filename, self._passphrase,
+                                                       migrate=False,
+                                                       cipher_settings=cipher_settings)
+            self._init_connection()
+
+    def checkpoint(self):
+        # Changes written to the WAL are transferred into the database
+        # file, so that the WAL doesn't grow and readers don't search it.
+        # If that fails, e.g. as the database is busy, changes remain in
+        # the WAL, until checkpointed after further changes, or on close.
+        self.checkpoint_pending = False
+        with contextlib.suppress(sqlite3.OperationalError):
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
 
     def close(self):
+        if self.checkpoint_pending:
+            self.checkpoint()
         self._db.close()
@@ -0,0 +1,97 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import os
+import csv
+import json
+
+from mypass import FormatError
+
+FORMATS = ['jsonl', 'csv']
+FIELDS = ['context', 'username', 'password', 'aliases']
+
+
+def guess_format(filename):
+    if os.path.splitext(filename)[1].lower() == '.csv':
+        return 'csv'
+    return 'jsonl'
+
+
+def _check_record(record, line):
+    if not isinstance(record, dict):
+        raise FormatError('Invalid record on line {}'.format(line))
+
+    context = record.get('context')
+    username = record.get('username') or ''
+    password = record.get('password')
+    aliases = record.get('aliases') or []
+
+    # In CSV files, aliases are separated by line breaks.
+    if isinstance(aliases, str):
+        aliases = aliases.splitlines()
+
+    if not isinstance(context, str) or not context:
+        raise FormatError('Missing context on line {}'.format(line))
+    if not isinstance(password, str):
+        raise FormatError('Missing password on line {}'.format(line))
+    if not isinstance(username, str):
+        raise FormatError('Invalid username on line {}'.format(line))
+    if not (isinstance(aliases, list) and all(isinstance(alias, str) and alias for alias in aliases)):
+        raise FormatError('Invalid aliases on line {}'.format(line))
+
+    return context, username, password, aliases
+
+
+def _read_jsonl(file):
+    for line, data in enumerate(file, 1):
+        if not data.strip():
+            continue
+        try:
+            record = json.loads(data)
+        except ValueError:
+            raise FormatError('Invalid JSON on line {}'.format(line))
+        yield _check_record(record, line)
+
+
+def _read_csv(file):
+    reader = csv.DictReader(file)
+    try:
+        for record in reader:
+            yield _check_record(record, reader.line_num)
+    except csv.Error as e:
+        raise FormatError('Invalid CSV on line {}: {}'.format(reader.line_num, e))
+
+
+def read_records(file, format):
+    if format == 'csv':
+        return _read_csv(file)
+    return _read_jsonl(file)
+
+
+def get_record_writer(file, format, compact):
+    # Records have the aliases of the context as fourth field if exported
+    # in compact form, rather than having a record for each alias.
+    fields = FIELDS if compact else FIELDS[:3]
+
+    if format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(fields)
+
+        def write(records):
+            writer.writerows(record[:3] + ['\n'.join(record[3])] if compact else record
+                             for record in records)
+    else:
+        def write(records):
+            for record in records:
+                file.write(json.dumps(dict(zip(fields, record))) + '\n')
+
+    return write
@@ -0,0 +1,114 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import os
+import string
+
+from mypass import Error, ConfigError
+
+CHARACTER_CLASSES = {
+    'lowercase': string.ascii_lowercase,
+    'uppercase': string.ascii_uppercase,
+    'digits': string.digits,
+    'punctuation': string.punctuation,
+}
+
+BUFFER_SIZE = 4096
+
+
+class RandomSource:
+    # Random bytes are read from the operating system in bulk, and turned
+    # into uniformly distributed choices by rejection sampling, i.e. values
+    # beyond the largest multiple of the number of choices are discarded,
+    # as otherwise the choices they wrap around to would be more likely.
+
+    def __init__(self):
+        self._buffer = b''
+        self._offset = 0
+
+    def _read(self, size):
+        if len(self._buffer) - self._offset < size:
+            self._buffer = os.urandom(max(size, BUFFER_SIZE))
+            self._offset = 0
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return data
+
+    def choices(self, population, k):
+        n = len(population)
+        size = ((n - 1).bit_length() + 7) // 8 or 1
+        space = 1 << (8 * size)
+        limit = space - space % n
+
+        result = []
+        while len(result) < k:
+            # Enough bytes for the remaining choices are read at
+            # once, accounting for the values that are discarded.
+            data = self._read(size * ((k - len(result)) * space // limit + 1))
+            if size == 1:
+                values = data
+            else:
+                values = (int.from_bytes(data[i:i + size], 'big') for i in range(0, len(data), size))
+            result.extend(population[value % n] for value in values if value < limit)
+        return result[:k]
+
+
+class PasswordGenerator:
+    # Passwords consist of characters of the given classes, at least one
+    # of each (if long enough), so that they are accepted by websites
+    # requiring them. Passwords lacking any are discarded, rather than
+    # inserting the missing characters, so that all valid passwords
+    # are equally likely.
+
+    def __init__(self, classes, random=None):
+        for name in classes:
+            if name not in CHARACTER_CLASSES:
+                raise ConfigError('Unknown character class: {}'.format(name))
+        if not classes:
+            raise ConfigError('No character classes given')
+
+        self._classes = [frozenset(CHARACTER_CLASSES[name]) for name in dict.fromkeys(classes)]
+        self._alphabet = ''.join(CHARACTER_CLASSES[name] for name in dict.fromkeys(classes))
+        self._random = random or RandomSource()
+
+    def generate(self, length):
+        required = self._classes if length >= len(self._classes) else []
+        while True:
+            password = ''.join(self._random.choices(self._alphabet, length))
+            if all(not chars.isdisjoint(password) for chars in required):
+                return password
+
+
+class PassphraseGenerator:
+    # Diceware passphrases, consisting of words chosen from a list.
+
+    def __init__(self, words, random=None):
+        if len(words) < 2:
+            raise Error('Wordlist must contain at least 2 words')
+        self._words = words
+        self._random = random or RandomSource()
+
+    def generate(self, count):
+        return '-'.join(self._random.choices(self._words, count))
+
+
+def read_wordlist(filename):
+    # Wordlists consist of one word per line, optionally preceded by the
+    # dice rolls it corresponds to, like the ones published by the EFF.
+    try:
+        with open(filename, encoding='utf-8') as file:
+            words = [line.split()[-1] for line in file if line.strip()]
+    except UnicodeDecodeError:
+        raise Error('{}: Unexpected encoding'.format(filename))
+    except OSError as e:
+        raise Error('{}: {}'.format(filename, e.strerror))
+    return list(dict.fromkeys(words))
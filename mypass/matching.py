@@ -0,0 +1,202 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import os
+import re
+import urllib.parse
+
+PUBLIC_SUFFIX_LISTS = [
+    # The list shipped by the distribution is preferred, since
+    # it is likely updated more often than the one bundled here.
+    '/usr/share/publicsuffix/public_suffix_list.dat',
+    os.path.join(os.path.dirname(__file__), 'public_suffix_list.dat'),
+]
+
+_public_suffix_list = None
+
+
+def _to_ascii(name):
+    try:
+        return name.encode('idna').decode('ascii')
+    except UnicodeError:
+        return name
+
+
+def _get_public_suffix_list():
+    global _public_suffix_list
+
+    if not _public_suffix_list:
+        rules = set()
+        wildcards = set()
+        exceptions = set()
+
+        for filename in PUBLIC_SUFFIX_LISTS:
+            try:
+                file = open(filename, encoding='utf-8')
+            except FileNotFoundError:
+                continue
+
+            with file:
+                for line in file:
+                    rule = line.strip().lower()
+                    if not rule or rule.startswith('//'):
+                        continue
+
+                    if rule.startswith('!'):
+                        names = exceptions
+                        rule = rule[1:]
+                    elif rule.startswith('*.'):
+                        names = wildcards
+                        rule = rule[2:]
+                    else:
+                        names = rules
+
+                    names.add(rule)
+                    names.add(_to_ascii(rule))
+            break
+
+        _public_suffix_list = (rules, wildcards, exceptions)
+
+    return _public_suffix_list
+
+
+def get_public_suffix_length(labels):
+    rules, wildcards, exceptions = _get_public_suffix_list()
+
+    for i in range(len(labels)):
+        name = '.'.join(labels[i:])
+        if name in exceptions:
+            return len(labels) - i - 1
+        if name in rules or '.'.join(labels[i + 1:]) in wildcards:
+            return len(labels) - i
+
+    # If no rule matches, the top-level domain is the public suffix.
+    return 1
+
+
+def _split_port(netloc):
+    return re.match(r'(.*?)(:\d*)?$', netloc).groups('')
+
+
+def _get_possible_paths(path):
+    parts = path.split('/')
+
+    while parts:
+        yield '/'.join(parts)
+
+        tail = parts.pop()
+        if tail != '':
+            parts.append('')
+
+
+def _get_min_labels(netloc):
+    # Parent domains are not considered for IP addresses,
+    # or if the host is a public suffix like "co.uk" itself.
+    if not re.search(r'[^0-9.:]', netloc):
+        return None
+
+    host, port = _split_port(netloc)
+    return get_public_suffix_length(host.rstrip('.').split('.')) + 1
+
+
+class _Node:
+    __slots__ = ['children', 'contexts']
+
+    def __init__(self):
+        self.children = {}
+        self.contexts = {}
+
+
+def _split_context(context):
+    host, sep, path = context.lower().partition('/')
+    return reversed(host.split('.')), sep + path
+
+
+class ContextIndex:
+
+    def __init__(self, contexts=()):
+        self._root = _Node()
+
+        for context in contexts:
+            self.add(context)
+
+    def add(self, context):
+        labels, path = _split_context(context)
+        node = self._root
+
+        for label in labels:
+            node = node.children.setdefault(label, _Node())
+
+        node.contexts[path] = context
+
+    def remove(self, context):
+        labels, path = _split_context(context)
+        nodes = [(None, self._root)]
+
+        for label in labels:
+            node = nodes[-1][1].children.get(label)
+            if not node:
+                return
+            nodes.append((label, node))
+
+        nodes[-1][1].contexts.pop(path, None)
+
+        # Prune nodes that neither hold contexts nor lead to any.
+        while len(nodes) > 1:
+            label, node = nodes.pop()
+            if node.contexts or node.children:
+                break
+            del nodes[-1][1].children[label]
+
+    def update(self, changes):
+        for change, context, id in changes:
+            if change == 'add':
+                self.add(context)
+            elif change == 'remove':
+                self.remove(context)
+
+    def match(self, url):
+        parsed = urllib.parse.urlparse(url)
+        labels = parsed.netloc.lower().split('.')
+        nodes = []
+        matches = []
+
+        node = self._root
+        for label in reversed(labels):
+            node = node.children.get(label)
+            if not node:
+                break
+            nodes.append(node)
+
+        # If the domain matches exactly, contexts with paths are considered
+        # first, from the most to the least specific, e.g. for the URL
+        # https://www.example.com/foo/bar: www.example.com/foo/bar,
+        # www.example.com/foo/, www.example.com/foo, www.example.com/
+        # and finally www.example.com.
+        if len(nodes) == len(labels):
+            contexts = nodes.pop().contexts
+            if contexts:
+                for path in _get_possible_paths(parsed.path.lower()):
+                    context = contexts.get(path)
+                    if context:
+                        matches.append(context)
+
+        # Then parent domains are considered, e.g. example.com,
+        # but not beyond the public suffix.
+        min_labels = _get_min_labels(parsed.netloc)
+        if min_labels:
+            for node in reversed(nodes[min_labels - 1:]):
+                context = node.contexts.get('')
+                if context:
+                    matches.append(context)
+
+        return matches
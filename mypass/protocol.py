@@ -0,0 +1,357 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import json
+import struct
+
+from mypass import (Error, ConfigError, DatabaseError, ProtocolError,
+                    CredentialsDoNotExist, CredentialsAlreadytExist, BatchError)
+
+# Clients start by sending a hello, consisting of the magic bytes and the
+# latest protocol version they support, and the daemon responds with the
+# version that is going to be used. Afterwards, each message is sent as
+# frame, consisting of the length of the payload and the payload itself,
+# a JSON-encoded array. Requests are encoded as [command, args] and
+# responses as [0, result] or [error code, error args].
+#
+# Since version 2, requests can also be encoded as [id, command, args],
+# in which case the id is prepended to the response as well. That way
+# clients can send multiple requests without waiting for the responses.
+# However, clients have to wait for the response to the hello before
+# sending requests with id, since the daemon might not support them.
+#
+# Since version 3, clients can set the TRACE flag in the version they
+# send with the hello, in which case the daemon appends the time it spent
+# serving each request to the response, i.e. [id, 0, result, timing].
+# Daemons that don't support it ignore the flag, as they don't
+# negotiate a version higher than they support.
+#
+# Clients that don't send a hello but directly start with a pickle
+# (which always starts with the PROTO opcode) are served using the
+# legacy protocol where requests and responses are pickled objects.
+# Conversely, the magic bytes start with a byte that is invalid in a
+# pickle, so that daemons only supporting the legacy protocol fail
+# immediately rather than blocking while waiting for more data.
+MAGIC = b'\x00MYP'
+VERSION = 3
+LEGACY_VERSION = 0
+TRACE = 0x80
+
+ERRORS = [
+    Error,
+    ConfigError,
+    DatabaseError,
+    ProtocolError,
+    CredentialsDoNotExist,
+    CredentialsAlreadytExist,
+    BatchError,
+]
+
+BUFFER_SIZE = 65536
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+HELLO = struct.Struct('!4sB')
+HEADER = struct.Struct('!I')
+
+# The PROTO opcode of pickle, which is only imported
+# on demand, when serving a client using the legacy protocol.
+_PICKLE_PROTO = 0x80
+
+
+def encode_error(error):
+    try:
+        code = ERRORS.index(type(error)) + 1
+    except ValueError:
+        code = 1
+    return [code, list(error.args)]
+
+
+def decode_error(code, args):
+    try:
+        cls = ERRORS[code - 1]
+    except IndexError:
+        cls = Error
+    return cls(*args)
+
+
+def parse_request(request, version):
+    try:
+        if len(request) == 3 and version >= 2:
+            id, command, args = request
+        else:
+            id = None
+            command, args = request
+    except (ValueError, TypeError):
+        raise ProtocolError('Malformed request')
+    if not (isinstance(command, str) and isinstance(args, list)):
+        raise ProtocolError('Malformed request')
+    return id, command, args
+
+
+def encode_frame(message):
+    payload = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError('Message too large')
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_response(id, result, timing=None):
+    response = [0, result]
+    if id is not None:
+        response.insert(0, id)
+    if timing is not None:
+        response.append(timing)
+    return encode_frame(response)
+
+
+def encode_error_response(id, error, timing=None):
+    response = encode_error(error)
+    if id is not None:
+        response.insert(0, id)
+    if timing is not None:
+        response.append(timing)
+    return encode_frame(response)
+
+
+def check_frame_length(length):
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError('Message too large')
+    return length
+
+
+def check_hello(hello):
+    magic, version = HELLO.unpack(hello)
+    if magic != MAGIC:
+        raise ProtocolError('Unexpected handshake')
+    return version & ~TRACE, bool(version & TRACE)
+
+
+def is_legacy_request(first_byte):
+    return first_byte == _PICKLE_PROTO
+
+
+class Connection:
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._buffer = bytearray(BUFFER_SIZE)
+        self._start = 0
+        self._end = 0
+        self.version = None
+        self.trace = False
+
+    def _fill(self, size):
+        while self._end - self._start < size:
+            # Move the buffered data to the front, and grow the buffer
+            # if necessary, in order to make room for the remaining data.
+            if self._start + size > len(self._buffer):
+                self._buffer[:self._end - self._start] = self._buffer[self._start:self._end]
+                self._end -= self._start
+                self._start = 0
+                if size > len(self._buffer):
+                    self._buffer.extend(bytes(size - len(self._buffer)))
+
+            # Read as much as is available with a single system call,
+            # which typically gets the header and payload at once.
+            with memoryview(self._buffer) as view:
+                count = self._reader.readinto(view[self._end:])
+            if not count:
+                raise EOFError
+            self._end += count
+
+    def _consume(self, size):
+        self._start += size
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > BUFFER_SIZE:
+                del self._buffer[BUFFER_SIZE:]
+
+    def _peek_frame_length(self):
+        return check_frame_length(HEADER.unpack_from(self._buffer, self._start)[0])
+
+    def _has_frame(self):
+        available = self._end - self._start
+        return (available >= HEADER.size and
+                available - HEADER.size >= self._peek_frame_length())
+
+    def _read_frame(self):
+        self._fill(HEADER.size)
+        length = self._peek_frame_length()
+        self._consume(HEADER.size)
+        return json.loads(self.read(length))
+
+    def _read_hello(self):
+        return check_hello(self.read(HELLO.size))
+
+    # The file-like interface below is used by pickle for the legacy protocol.
+
+    def read(self, size):
+        self._fill(size)
+        with memoryview(self._buffer) as view:
+            data = bytes(view[self._start:self._start + size])
+        self._consume(size)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:] = data
+        return len(data)
+
+    def readline(self):
+        size = 1
+        while True:
+            self._fill(size)
+            index = self._buffer.find(b'\n', self._start, self._end)
+            if index != -1:
+                return self.read(index - self._start + 1)
+            size = self._end - self._start + 1
+
+    def write(self, data):
+        with memoryview(data) as view:
+            while view:
+                view = view[self._writer.write(view):]
+        return len(data)
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+class ServerConnection(Connection):
+
+    def __init__(self, reader, writer):
+        super().__init__(reader, writer)
+        self._output = bytearray()
+
+    def _negotiate(self):
+        self._fill(1)
+        if is_legacy_request(self._buffer[self._start]):
+            self.version = LEGACY_VERSION
+        else:
+            version, trace = self._read_hello()
+            self.version = min(version, VERSION)
+            self.trace = trace and self.version >= 3
+            self._output += HELLO.pack(MAGIC, self.version)
+
+    def has_buffered_request(self):
+        if self.version == LEGACY_VERSION:
+            return self._end > self._start
+        return self._has_frame()
+
+    def read_request(self):
+        if self.version is None:
+            self._negotiate()
+
+        if self.version == LEGACY_VERSION:
+            import pickle
+            command, args = pickle.load(self)
+            return None, command, args
+
+        try:
+            request = self._read_frame()
+        except ValueError:
+            raise ProtocolError('Malformed request')
+        return parse_request(request, self.version)
+
+    def write_response(self, id, result, timing=None):
+        if self.version == LEGACY_VERSION:
+            import pickle
+            self._output += pickle.dumps(result)
+        else:
+            self._output += encode_response(id, result, timing)
+
+    def write_error(self, id, error, timing=None):
+        if self.version == LEGACY_VERSION:
+            import pickle
+            self._output += pickle.dumps(error)
+        else:
+            self._output += encode_error_response(id, error, timing)
+
+    def flush(self):
+        # Responses are written at once after all requests that
+        # have been received together have been processed.
+        if self._output:
+            output = self._output
+            self._output = bytearray()
+            self.write(output)
+
+
+class ClientConnection(Connection):
+
+    def __init__(self, reader, writer, trace=False):
+        super().__init__(reader, writer)
+        self.trace = trace
+        self.timing = None
+
+        # The response to the hello is read along with the response to
+        # the first request, so that the handshake adds no round trip.
+        self.write(HELLO.pack(MAGIC, VERSION | (TRACE if trace else 0)))
+
+    def _read_response(self):
+        if self.version is None:
+            self.version = self._read_hello()[0]
+            self.trace = self.trace and self.version >= 3
+
+        # If tracing, the timing of the daemon
+        # for the last response is kept around.
+        response = self._read_frame()
+        if self.trace:
+            self.timing = response.pop()
+        return response
+
+    def call(self, command, args):
+        self.timing = None
+        self.write(encode_frame([command, args]))
+
+        code, result = self._read_response()
+        if code:
+            raise decode_error(code, result)
+        return result
+
+    def call_many(self, calls, window):
+        calls = enumerate(calls)
+
+        # Until the handshake is complete, we don't know whether
+        # the daemon supports request ids, so the first request
+        # is sent on its own, and if not supported, all others too.
+        if self.version is None or self.version < 2:
+            for index, (command, args) in calls:
+                try:
+                    yield index, self.call(command, args)
+                except Error as e:
+                    yield index, e
+
+                if self.version >= 2:
+                    break
+
+        pending = 0
+        exhausted = False
+        while not exhausted or pending:
+            # Send as many requests as the window allows in a single write,
+            # then wait for half of the responses before sending more.
+            frames = bytearray()
+            for index, (command, args) in calls:
+                frames += encode_frame([index, command, args])
+                pending += 1
+                if pending == window:
+                    break
+            else:
+                exhausted = True
+
+            if frames:
+                self.write(frames)
+
+            while pending > (0 if exhausted else window // 2):
+                index, code, result = self._read_response()
+                pending -= 1
+                yield index, decode_error(code, result) if code else result
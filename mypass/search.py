@@ -0,0 +1,234 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import re
+import math
+import heapq
+import operator
+from collections import Counter
+
+# Minimum fraction of the trigrams of a query a context or username
+# must share in order to be considered a match, if it doesn't contain
+# the query as a substring.
+SIMILARITY = 0.3
+
+_WORD_REGEXP = re.compile(r'[^\W_]+')
+
+# Besides trigrams, the first up to three characters of the text and of
+# each word are indexed, prefixed with a character that can't be searched
+# for, so that matches at the beginning are found without checking all
+# texts containing the query, and to find texts for queries shorter than
+# a trigram.
+_TEXT_START = '\1'
+_WORD_START = '\0'
+
+_get_key = operator.attrgetter('key')
+
+
+def _get_trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _get_grams(text):
+    grams = _get_trigrams(text)
+    grams.update(_TEXT_START + text[:n] for n in range(1, 4))
+    for word in _WORD_REGEXP.findall(text):
+        grams.update(_WORD_START + word[:n] for n in range(1, 4))
+    return grams
+
+
+def _is_word_prefix(text, query):
+    index = text.find(query)
+    while index != -1:
+        if index == 0 or not text[index - 1].isalnum():
+            return True
+        index = text.find(query, index + 1)
+    return False
+
+
+class _Document:
+    __slots__ = ['text', 'key', 'contexts']
+
+    def __init__(self, text):
+        self.text = text
+        self.key = (len(text), text)
+        self.contexts = {}
+
+
+class SearchIndex:
+    # Contexts and usernames are indexed by their trigrams. A username
+    # matches all contexts referring to the credentials it belongs to.
+    # Identical texts share a document, e.g. a username used for many
+    # contexts, so that they are only checked and ranked once.
+
+    def __init__(self):
+        self._postings = {}
+        self._docs = {}
+        self._contexts_by_id = {}
+        self._usernames_by_id = {}
+
+    def _link(self, text, context):
+        text = text.lower()
+        doc = self._docs.get(text)
+
+        if not doc:
+            doc = self._docs[text] = _Document(text)
+            for gram in _get_grams(text):
+                posting = self._postings.get(gram)
+                if posting is None:
+                    posting = self._postings[gram] = set()
+                posting.add(doc)
+
+        doc.contexts[context] = doc.contexts.get(context, 0) + 1
+
+    def _unlink(self, text, context):
+        doc = self._docs[text.lower()]
+        count = doc.contexts.pop(context) - 1
+
+        if count:
+            doc.contexts[context] = count
+        elif not doc.contexts:
+            del self._docs[doc.text]
+            for gram in _get_grams(doc.text):
+                posting = self._postings[gram]
+                posting.discard(doc)
+                if not posting:
+                    del self._postings[gram]
+
+    def _add_context(self, context, id):
+        contexts = self._contexts_by_id.setdefault(id, set())
+        if context in contexts:
+            return
+
+        contexts.add(context)
+        self._link(context, context)
+        for username in self._usernames_by_id.get(id, ()):
+            self._link(username, context)
+
+    def _remove_context(self, context, id):
+        contexts = self._contexts_by_id.get(id)
+        if not contexts or context not in contexts:
+            return
+
+        contexts.remove(context)
+        if not contexts:
+            del self._contexts_by_id[id]
+
+        self._unlink(context, context)
+        for username in self._usernames_by_id.get(id, ()):
+            self._unlink(username, context)
+
+    def _set_usernames(self, id, usernames):
+        old_usernames = self._usernames_by_id.pop(id, set())
+        new_usernames = {username for username in usernames if username}
+        contexts = self._contexts_by_id.get(id, ())
+
+        for username in old_usernames - new_usernames:
+            for context in contexts:
+                self._unlink(username, context)
+        for username in new_usernames - old_usernames:
+            for context in contexts:
+                self._link(username, context)
+
+        if new_usernames:
+            self._usernames_by_id[id] = new_usernames
+
+    def update(self, changes, usernames):
+        for change, context, id in changes:
+            if change == 'add':
+                self._add_context(context, id)
+            elif change == 'remove':
+                self._remove_context(context, id)
+
+        for id, names in usernames.items():
+            self._set_usernames(id, names)
+
+    def _find_substrings(self, query):
+        empty = set()
+        prefix = query[:3]
+
+        if len(query) < 3:
+            candidates = []
+        else:
+            # Texts containing the query have all of its trigrams.
+            candidates = sorted((self._postings.get(gram, empty) for gram in _get_trigrams(query)), key=len)
+
+        # Yield texts starting with the query first, then those with
+        # a word starting with the query, then all other matches, along
+        # with a function to check the match unless known to be exact.
+        exact = len(query) <= 3
+        found = set()
+        for gram, check in [(_TEXT_START + prefix, str.startswith),
+                            (_WORD_START + prefix, _is_word_prefix)]:
+            docs = self._postings.get(gram, empty).intersection(*candidates)
+            if exact:
+                docs -= found
+                found |= docs
+                check = None
+            yield docs, check
+
+        if candidates:
+            yield candidates[0].intersection(*candidates[1:]) - found, (None if exact else operator.contains)
+
+    def _find_similar(self, query):
+        grams = list(_get_trigrams(query))
+        if not grams:
+            return []
+
+        # Texts sharing at least the given number of trigrams
+        # with the query must occur in one of the rarest postings.
+        postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+        min_shared = math.ceil(len(postings) * SIMILARITY)
+        rarest = postings[:len(postings) - min_shared + 1]
+        others = postings[len(rarest):]
+
+        counts = Counter()
+        for posting in rarest:
+            counts.update(posting)
+
+        similar = []
+        for doc, count in counts.items():
+            count += sum(1 for posting in others if doc in posting)
+            if count >= min_shared and query not in doc.text:
+                similar.append((-count, doc.key, doc))
+        similar.sort(key=operator.itemgetter(0, 1))
+        return [doc for count, key, doc in similar]
+
+    def _add_contexts(self, results, docs, limit, query=None, check=None):
+        # Documents are checked lazily, in the order they are ranked.
+        # The first ones usually suffice, but as documents might not
+        # match or share contexts, all of them might be needed.
+        for n in (limit - len(results), len(docs)):
+            for doc in heapq.nsmallest(n, docs, key=_get_key):
+                if check and not check(doc.text, query):
+                    continue
+                for context in heapq.nsmallest(limit - len(results), doc.contexts.keys() - results.keys()):
+                    results[context] = None
+                if len(results) >= limit:
+                    return
+
+    def search(self, query, limit):
+        query = query.strip().lower()
+        results = {}
+
+        if query:
+            for docs, check in self._find_substrings(query):
+                self._add_contexts(results, docs, limit, query, check)
+                if len(results) >= limit:
+                    break
+            else:
+                for doc in self._find_similar(query):
+                    self._add_contexts(results, [doc], limit)
+                    if len(results) >= limit:
+                        break
+
+        return list(results)
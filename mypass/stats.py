@@ -0,0 +1,112 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import sys
+import time
+import bisect
+
+# Upper bounds (in milliseconds) of the buckets of the latency histograms,
+# followed by a bucket for requests that took even longer.
+LATENCY_BUCKETS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class Request:
+    __slots__ = ('command', 'start', 'execute', 'serialize', 'failed', 'trace', 'spans')
+
+    def __init__(self, command, trace):
+        self.command = command
+        self.start = time.perf_counter()
+        self.execute = 0
+        self.serialize = 0
+        self.failed = False
+        self.trace = trace
+        self.spans = []
+
+
+class Stats:
+    # Stats are only recorded and read by the thread serving the
+    # connections, so that no locking is necessary. Requests for
+    # unknown commands are counted together, so that clients can't
+    # make the daemon keep track of arbitrary names.
+
+    def __init__(self, commands, slow_request=0):
+        self._start = time.monotonic()
+        self._slow_request = slow_request
+        self._commands = {command: None for command in commands}
+        self._connections = 0
+        self._total_connections = 0
+
+    def connection_opened(self):
+        self._connections += 1
+        self._total_connections += 1
+
+    def connection_closed(self):
+        self._connections -= 1
+
+    def begin(self, command, trace=False):
+        return Request(command, trace)
+
+    def end(self, request):
+        elapsed = (time.perf_counter() - request.start) * 1000
+        execute = request.execute * 1000
+        serialize = request.serialize * 1000
+
+        command = request.command
+        if not (isinstance(command, str) and command in self._commands):
+            command = 'unknown'
+        stats = self._commands.get(command)
+        if not stats:
+            stats = self._commands[command] = {
+                'count': 0,
+                'errors': 0,
+                'time': 0,
+                'execute': 0,
+                'serialize': 0,
+                'max': 0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+
+        stats['count'] += 1
+        stats['errors'] += request.failed
+        stats['time'] += elapsed
+        stats['execute'] += execute
+        stats['serialize'] += serialize
+        stats['max'] = max(stats['max'], elapsed)
+        stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+        # Only the command is logged, since the
+        # arguments might contain confidential data.
+        if self._slow_request and elapsed >= self._slow_request:
+            print('{} Slow request: {} took {:.1f} ms ({:.1f} ms executing, {:.1f} ms serializing)'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S'), command, elapsed, execute, serialize
+            ), file=sys.stderr, flush=True)
+
+    def get_stats(self):
+        return {
+            'uptime': time.monotonic() - self._start,
+            'connections': self._connections,
+            'total_connections': self._total_connections,
+            'buckets': LATENCY_BUCKETS,
+            'commands': {command: stats for command, stats in self._commands.items() if stats},
+        }
+
+
+def get_percentile(stats, buckets, percentile):
+    # Percentiles are estimated by the upper bound of the bucket they fall
+    # into, but never exceed the maximum latency actually observed.
+    rank = stats['count'] * percentile
+    count = 0
+    for bound, bucket in zip(buckets, stats['histogram']):
+        count += bucket
+        if count >= rank:
+            return min(bound, stats['max'])
+    return stats['max']
@@ -0,0 +1,202 @@
+# Copyright (c) 2014-2025 Sebastian Noack
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# If the MYPASS_TRACE environment variable is set, the time spent in each
+# phase of running mypass is recorded, including the time the daemon spent
+# serving each request, and written to stderr when exiting, or if the
+# variable is set to a file name ending with .json, written to that file
+# as Chrome trace events. This module is imported on startup, so it must
+# not import anything that isn't needed unless tracing.
+
+import os
+import sys
+import time
+import _thread
+
+ENABLED = bool(os.environ.get('MYPASS_TRACE'))
+IMPORTED = time.perf_counter()
+
+_local = _thread._local()
+
+
+class _Collector:
+    def __init__(self):
+        self.spans = []
+        self.depth = 0
+
+
+class _Span:
+    __slots__ = ('_collector', '_name', '_start', '_server_timing')
+
+    def __init__(self, collector, name):
+        self._collector = collector
+        self._name = name
+        self._server_timing = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._collector.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._collector.depth -= 1
+        self._collector.spans.append([self._name, self._start, time.perf_counter(),
+                                      self._collector.depth, self._server_timing])
+
+    def set_server_timing(self, timing):
+        self._server_timing = timing
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set_server_timing(self, timing):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+_collector = _Collector() if ENABLED else None
+
+
+def _get_collector():
+    # Spans recorded by the daemon, while serving a request of
+    # a client that is tracing, are collected per thread.
+    return getattr(_local, 'collector', None) or _collector
+
+
+def span(name):
+    collector = _get_collector()
+    if collector:
+        return _Span(collector, name)
+    return _NULL_SPAN
+
+
+def record(name, start):
+    # Records a span that started before tracing could start, e.g. importing modules.
+    if _collector:
+        _collector.spans.append([name, start, time.perf_counter(), _collector.depth, None])
+
+
+def start_collecting():
+    _local.collector = _Collector()
+
+
+def stop_collecting():
+    collector = _local.collector
+    _local.collector = None
+    return collector.spans
+
+
+def get_server_timing(start, spans):
+    # The daemon sends the spans recorded while serving a request
+    # (in milliseconds, relative to when the request was received),
+    # so that the client can include them in its trace.
+    return {
+        'pid': os.getpid(),
+        'total': (time.perf_counter() - start) * 1000,
+        'spans': [[name, (span_start - start) * 1000, (span_end - span_start) * 1000, depth]
+                  for name, span_start, span_end, depth, server_timing in spans],
+    }
+
+
+def _get_process_start():
+    # The time the process was started, in order to tell how long the
+    # interpreter took to start up, which is only known on Linux, with
+    # the resolution of the clock ticks the start time is given in.
+    try:
+        with open('/proc/self/stat') as file:
+            fields = file.read().rpartition(')')[2].split()
+        uptime = time.clock_gettime(time.CLOCK_BOOTTIME)
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+    return IMPORTED - max(uptime - started - (time.perf_counter() - IMPORTED), 0)
+
+
+def _get_events():
+    # Spans of the daemon are placed in the middle of the span of
+    # the request they were recorded for, since the clocks of the
+    # processes aren't comparable, assuming symmetric latency.
+    events = []
+    for name, start, end, depth, server_timing in sorted(_collector.spans, key=lambda s: (s[1], s[3])):
+        events.append((name, start, end, depth, os.getpid()))
+        if server_timing:
+            offset = start + max(end - start - server_timing['total'] / 1000, 0) / 2
+            for server_name, server_start, duration, server_depth in sorted(server_timing['spans'],
+                                                                             key=lambda s: (s[1], s[3])):
+                server_start = offset + server_start / 1000
+                events.append(('daemon: ' + server_name, server_start, server_start + duration / 1000,
+                               depth + 1 + server_depth, server_timing['pid']))
+    return events
+
+
+def _write_breakdown(events, origin):
+    print('{:>10} {:>10}  phase (ms)'.format('start', 'duration'), file=sys.stderr)
+    for name, start, end, depth, pid in events:
+        print('{:>10.3f} {:>10.3f}  {}{}'.format((start - origin) * 1000, (end - start) * 1000,
+                                                 '  ' * depth, name), file=sys.stderr)
+    print('{:>10} {:>10.3f}  total'.format('', (time.perf_counter() - origin) * 1000), file=sys.stderr)
+
+
+def _write_chrome_trace(events, origin, filename):
+    import json
+
+    pids = {os.getpid(): 'mypass'}
+    trace_events = []
+    for name, start, end, depth, pid in events:
+        pids.setdefault(pid, 'mypass daemon')
+        trace_events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': pid,
+                             'ts': (start - origin) * 1e6, 'dur': (end - start) * 1e6})
+    for pid, process_name in pids.items():
+        trace_events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                             'args': {'name': process_name}})
+
+    with open(filename, 'w') as file:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+
+
+def _report(filename, process_start):
+    origin = IMPORTED
+    if process_start is not None:
+        _collector.spans.append(['startup', process_start, IMPORTED, 0, None])
+        origin = process_start
+
+    events = _get_events()
+    if filename.endswith('.json'):
+        _write_chrome_trace(events, origin, filename)
+    else:
+        _write_breakdown(events, origin)
+
+
+def start_profiling(filename):
+    import atexit
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def dump():
+        profiler.disable()
+        profiler.dump_stats(filename)
+    atexit.register(dump)
+
+
+if ENABLED:
+    import atexit
+    atexit.register(_report, os.environ['MYPASS_TRACE'], _get_process_start())
+
+if os.environ.get('MYPASS_PROFILE'):
+    start_profiling(os.environ['MYPASS_PROFILE'])
@@ -165,9 +165,9 @@ setup(name='mypass',
       packages=['mypass'],
       scripts=['bin/mypass'],
       data_files=[('share/man/man1', [MANPAGE])],
-      package_data={'mypass': ['extension/*', 'native-messaging-hosts/*/*.json']},
+      package_data={'mypass': ['extension/*', 'native-messaging-hosts/*/*.json', 'public_suffix_list.dat']},
       install_requires=['pycryptodome', 'argcomplete'],
-      python_requires='>=3.4',
+      python_requires='>=3.7',
       cmdclass={
           'build_py': BuildPy,
           'build_manpages': BuildManpages,
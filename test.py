@@ -1,4 +1,5 @@
 import os
+import sys
 import re
 import string
 
@@ -56,6 +57,7 @@ def test_cli():
                           string.punctuation)
 
     run('mypass lock')
+    assert not os.path.exists(os.path.join(os.environ['HOME'], '.config', 'mypass', 'db-wal'))
     run('mypass list', [('Unlock database: ', 'masterpw'),
                         ('bar.example.com', None),
                         ('foo.example.com', None),
@@ -79,6 +81,26 @@ def test_cli():
                         ('same-as-foo.example.com', None)])
     run('mypass get new.example.com', [('jeff  password3', None)])
     run('mypass get bar.example.com', [('password2', None)])
+    run('mypass search example', [('bar.example.com', None),
+                                  ('new.example.com', None),
+                                  ('same-as-foo.example.com', None)])
+    run('mypass search jef', [('new.example.com', None)])
+    run('mypass search --limit=1 exampel', [('bar.example.com', None)])
+
+    filename = os.path.join(os.environ['HOME'], 'import.csv')
+    with open(filename, 'w') as file:
+        file.write('context,username,password\r\n'
+                   'imported.example.com,jim,password4\r\n'
+                   'bar.example.com,,password5\r\n')
+    run('mypass import --on-conflict=skip ' + filename, [('1 added, 0 updated, 1 skipped', None)])
+    run('mypass get imported.example.com', [('jim  password4', None)])
+    run('mypass get bar.example.com', [('password2', None)])
+    run('mypass export --format=csv', [('context,username,password\r', None),
+                                       ('bar.example.com,,password2\r', None),
+                                       ('imported.example.com,jim,password4\r', None),
+                                       ('new.example.com,jeff,password3\r', None),
+                                       ('same-as-foo.example.com,,password1\r', None)])
+    run('mypass remove imported.example.com')
     run('mypass changepw', [('New passphrase: ', 'masterpw2'),
                             ('Verify passphrase: ', 'masterpw2')])
     run('mypass lock')
@@ -118,3 +140,374 @@ def test_bash_completion():
         shell.sendintr()
         shell.expect_exact('^C\r\n')
         shell.expect_exact(PROMPT)
+
+
+def test_batch():
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+
+    filename = os.path.join(os.environ['HOME'], 'batch.txt')
+    with open(filename, 'w') as file:
+        file.write('# comment\n'
+                   'add example.org jim "pw 2"\n'
+                   '\n'
+                   'alias example.org www.example.org\n'
+                   'remove example.com\n'
+                   'add example.net jane pw3\n'
+                   'add example.org jim pw4\n')
+    output, status = pexpect.runu('mypass batch ' + filename, withexitstatus=True, timeout=TIMEOUT)
+    assert status == 1
+    assert output == 'Line 7: Credentials already exist, no changes have been made\r\n'
+    run('mypass list', [('example.com', None)])
+
+    with open(filename, 'w') as file:
+        file.write('add example.org jim "pw 2"\n'
+                   'alias example.org www.example.org\n'
+                   'remove example.com\n'
+                   'add example.org jim pw4 --override\n'
+                   'rename example.org jim --new-username=jack\n')
+    run('mypass batch ' + filename, [('5 commands applied', None)])
+    run('mypass list', [('example.org', None),
+                        ('www.example.org', None)])
+    run('mypass get www.example.org', [('jack  pw4', None)])
+
+
+def test_exec():
+    run('mypass add example.com joe pw1', [('New passphrase: ', 'masterpw'),
+                                           ('Verify passphrase: ', 'masterpw')])
+    run('mypass add example.com jim pw2')
+    run('mypass add example.org', [('Password: ', 'pw 3')])
+
+    run('''mypass exec --env=A=example.com:jim -e B=example.org -- sh -c 'echo "$A,$B"' ''', [('pw2,pw 3', None)])
+    run('''mypass exec --files -e A=example.com:joe -- sh -c 'cat "$A"; echo' ''', [('pw1', None)])
+
+    output, status = pexpect.runu('mypass exec -e A=example.com true', withexitstatus=True, timeout=TIMEOUT)
+    assert status == 1
+    assert output == 'example.com: Multiple credentials exist, the username must be given\r\n'
+
+
+def test_client_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    from mypass import DatabaseLocked
+    from mypass.client import ClientPool
+
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+
+    with ClientPool(size=2, cache_ttl=60) as pool:
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(pool.get_credentials, ['example.com'] * 100))
+        assert results == [[['joe', 'pw']]] * 100
+
+        pool.store_credentials('example.com', 'joe', 'pw2', override=True)
+        assert pool.get_credentials('example.com') == [['joe', 'pw2']]
+
+        # The connection closed by the daemon is replaced,
+        # once the database has been unlocked again.
+        pool.lock_database()
+        with pytest.raises(DatabaseLocked):
+            pool.get_contexts()
+        pool.unlock_database('masterpw')
+        assert pool.get_contexts() == ['example.com']
+
+
+def test_async_client():
+    import asyncio
+    from mypass import CredentialsDoNotExist
+    from mypass.asyncclient import AsyncClient
+
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+
+    async def main():
+        async with AsyncClient() as client:
+            results = await asyncio.gather(*[client.get_credentials('example.com') for _ in range(100)])
+            assert results == [[['joe', 'pw']]] * 100
+
+            task = asyncio.ensure_future(client.get_contexts())
+            await asyncio.sleep(0)
+            task.cancel()
+            assert await client.get_usernames('example.com') == ['joe']
+
+            with pytest.raises(CredentialsDoNotExist):
+                await client.get_credentials('example.org')
+
+    asyncio.run(main())
+
+
+def test_rotate():
+    run('mypass add a.example.com joe pw1', [('New passphrase: ', 'masterpw'),
+                                             ('Verify passphrase: ', 'masterpw')])
+    run('mypass add a.example.com jim pw2')
+    run('mypass add b.example.com jane pw3')
+    run('mypass add example.org jack pw4')
+
+    run('mypass rotate --length=20 *.EXAMPLE.com', [('a.example.com  jim', None),
+                                                    ('a.example.com  joe', None),
+                                                    ('b.example.com  jane', None),
+                                                    ('3 passwords rotated', None)])
+    output = pexpect.runu('mypass get a.example.com', timeout=TIMEOUT)
+    assert re.match(r'^jim  \S{20}\r\njoe  \S{20}\r\n$', output)
+    run('mypass get example.org', [('jack  pw4', None)])
+
+    config_dir = os.path.join(os.environ['HOME'], '.config', 'mypass')
+    with open(os.path.join(config_dir, 'wordlist.txt'), 'w') as file:
+        file.write('11111\tfoo\n11112\tbar\n')
+    with open(os.path.join(config_dir, 'config.ini'), 'w') as file:
+        file.write('[password]\n'
+                   'words = 4\n'
+                   'wordlist = ~/.config/mypass/wordlist.txt\n')
+    run('mypass rotate example.org', [('example.org  jack', None),
+                                      ('1 passwords rotated', None)])
+    output = pexpect.runu('mypass get example.org', timeout=TIMEOUT)
+    assert re.match(r'^jack  (foo|bar)(-(foo|bar)){3}\r\n$', output)
+
+
+def test_context_matching():
+    from mypass.matching import ContextIndex
+
+    index = ContextIndex(['co.uk', 'example.co.uk', 'www.example.co.uk/login',
+                          'example.com', 'example.com/foo'])
+
+    # Public suffixes are never matched for subdomains.
+    assert index.match('https://other.co.uk/') == []
+    assert index.match('https://www.example.co.uk/') == ['example.co.uk']
+
+    # Contexts with a path are preferred, if the domain matches exactly.
+    assert index.match('https://www.example.co.uk/login/form') == ['www.example.co.uk/login',
+                                                                   'example.co.uk']
+    assert index.match('https://example.com/foo/bar') == ['example.com/foo', 'example.com']
+    assert index.match('https://www.example.com/foo') == ['example.com']
+
+
+def test_native_messaging_host():
+    import json
+    import struct
+    import subprocess
+
+    run('mypass add example.co.uk joe pw', [('New passphrase: ', 'masterpw'),
+                                            ('Verify passphrase: ', 'masterpw')])
+
+    requests = [{'action': 'get-credentials', 'url': 'https://www.example.co.uk/'},
+                {'action': 'get-credentials', 'urls': ['https://other.co.uk/', 'https://example.co.uk/']},
+                {'action': 'search', 'query': 'example', 'id': 1}]
+    input = b''
+    for request in requests:
+        data = json.dumps(request).encode('utf-8')
+        input += struct.pack('I', len(data)) + data
+
+    output = subprocess.run(['mypass'], input=input, stdout=subprocess.PIPE,
+                            check=True, timeout=TIMEOUT).stdout
+    responses = []
+    while output:
+        length = struct.unpack('I', output[:4])[0]
+        responses.append(json.loads(output[4:4 + length].decode('utf-8')))
+        output = output[4 + length:]
+
+    assert responses == [{'status': 'ok', 'credentials': [{'username': 'joe', 'password': 'pw'}]},
+                         {'status': 'ok', 'credentials': [None, [{'username': 'joe', 'password': 'pw'}]]},
+                         {'status': 'ok', 'contexts': ['example.co.uk'], 'id': 1}]
+
+
+def test_invalid_requests():
+    from mypass import ProtocolError
+    from mypass.client import Client
+
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+
+    with Client() as client:
+        for command, args in [('get-credentials', []),
+                              ('complete-contexts', [1, 2]),
+                              ('batch', [[['delete-context', []]]])]:
+            with pytest.raises(ProtocolError):
+                client.call(command, *args)
+
+        # Malformed requests close the connection, but not the daemon.
+        with pytest.raises(EOFError):
+            client._connection.call('get-credentials', 'example.com')
+    run('mypass get example.com', [('joe  pw', None)])
+
+
+def test_abandoned_transfers():
+    from mypass import Error
+    from mypass.client import Client
+
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+
+    # Imports and exports are discarded, once the client disconnects.
+    with Client() as client:
+        import_id = client.call('begin-import')
+        client.call('add-import-records', import_id, [['example.org', '', 'pw', []]])
+        export_id = client.call('begin-export', False)
+        assert client.call('get-export-records', export_id, 1) == [['example.com', 'joe', 'pw']]
+
+    with Client() as client:
+        with pytest.raises(Error, match='Unknown import'):
+            client.call('commit-import', import_id, 'fail', False)
+        with pytest.raises(Error, match='Unknown export'):
+            client.call('get-export-records', export_id, 1)
+
+
+def test_reencrypt():
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+
+    output, status = pexpect.runu('mypass calibrate --time=0.1', withexitstatus=True, timeout=TIMEOUT)
+    assert status == 0
+    assert re.match(r'^kdf_iter = \d+\r\n$', output)
+
+    config = os.path.join(os.environ['HOME'], '.config', 'mypass', 'config.ini')
+    with open(config, 'w') as file:
+        file.write('[database]\n'
+                   'kdf_iter = 1000\n'
+                   'cipher_hmac_algorithm = HMAC_SHA512\n')
+    run('mypass reencrypt')
+    run('mypass lock')
+    run('mypass get example.com', [('Unlock database: ', 'masterpw'),
+                                   ('joe  pw', None)])
+
+    os.unlink(config)
+    run('mypass lock')
+    output, status = pexpect.runu('mypass get example.com', events={'Unlock database: ': 'masterpw\n'},
+                                  withexitstatus=True, timeout=TIMEOUT)
+    assert status == 1
+    assert output.endswith('Wrong passphrase or broken database\r\n')
+
+
+def run_sql(*statements):
+    # Runs the given statements on the database, which must be locked,
+    # with SQLCipher preloaded, returning the rows of the last statement.
+    import json
+    import subprocess
+    from mypass.client import _find_sqlcipher
+
+    script = ('import sys, json, sqlite3\n'
+              'from mypass.config import get_config\n'
+              'from mypass.db import get_cipher_settings, _set_cipher_settings\n'
+              'db = sqlite3.connect(get_config("database", "path"))\n'
+              'db.execute("PRAGMA key = \'masterpw\'")\n'
+              '_set_cipher_settings(db.cursor(), get_cipher_settings())\n'
+              'for statement in sys.argv[1:]:\n'
+              '    rows = db.execute(statement).fetchall()\n'
+              'db.commit()\n'
+              'print(json.dumps(rows))\n')
+    env = dict(os.environ, LD_PRELOAD=_find_sqlcipher())
+    output = subprocess.run([sys.executable, '-c', script] + list(statements), env=env,
+                            stdout=subprocess.PIPE, check=True, timeout=TIMEOUT).stdout
+    return json.loads(output.decode('utf-8'))
+
+
+def test_schema_migration():
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+    run('mypass lock')
+    assert run_sql('PRAGMA user_version') == [[1]]
+
+    # Databases created before schema versions were introduced
+    # are at version 0, and lack the indexes added in version 1.
+    run_sql('DROP INDEX credentials_id_index',
+            'DROP INDEX contexts_id_index',
+            'PRAGMA user_version = 0')
+    run('mypass get example.com', [('Unlock database: ', 'masterpw'),
+                                   ('joe  pw', None)])
+    run('mypass lock')
+    assert run_sql('PRAGMA user_version') == [[1]]
+    assert run_sql("SELECT name FROM sqlite_master WHERE name LIKE '%_id_index' ORDER BY name") == [
+        ['contexts_id_index'], ['credentials_id_index']
+    ]
+
+    # Databases of a newer version are left alone.
+    run_sql('PRAGMA user_version = 5')
+    output, status = pexpect.runu('mypass get example.com', events={'Unlock database: ': 'masterpw\n'},
+                                  withexitstatus=True, timeout=TIMEOUT)
+    assert status == 1
+    assert output.endswith('Database has been created by a newer version of mypass\r\n')
+    assert run_sql('PRAGMA user_version') == [[5]]
+
+
+def test_stats():
+    config_dir = os.path.join(os.environ['HOME'], '.config', 'mypass')
+    os.makedirs(config_dir)
+    with open(os.path.join(config_dir, 'config.ini'), 'w') as file:
+        file.write('[daemon]\n'
+                   'slow_request = 1\n')
+
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+    run('mypass get example.com', [('joe  pw', None)])
+
+    output, status = pexpect.runu('mypass stats', withexitstatus=True, timeout=TIMEOUT)
+    assert status == 0
+    assert re.search(r'^get-credentials +1 +0 ', output, re.MULTILINE)
+    assert re.search(r'^store-credentials +1 +0 ', output, re.MULTILINE)
+
+    with open(os.path.join(config_dir, 'log')) as file:
+        log = file.read()
+    assert 'Slow request: init took' in log
+    assert 'masterpw' not in log
+
+
+def test_asyncio_daemon():
+    config_dir = os.path.join(os.environ['HOME'], '.config', 'mypass')
+    os.makedirs(config_dir)
+    with open(os.path.join(config_dir, 'config.ini'), 'w') as file:
+        file.write('[daemon]\n'
+                   'mode = asyncio\n')
+
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+    run('mypass add example.org', [('Password: ', 'pw2')])
+    run('mypass get example.com', [('joe  pw', None)])
+    run('mypass list', [('example.com', None),
+                        ('example.org', None)])
+    run('mypass search org', [('example.org', None)])
+
+    # Read-only connections are opened again after the passphrase changed.
+    run('mypass changepw', [('New passphrase: ', 'masterpw2'),
+                            ('Verify passphrase: ', 'masterpw2')])
+    run('mypass get example.org', [('pw2', None)])
+    run('mypass lock')
+    run('mypass get example.com', [('Unlock database: ', 'masterpw2'),
+                                   ('joe  pw', None)])
+
+
+def test_trace():
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+
+    output, status = pexpect.runu('mypass get example.com', env=dict(os.environ, MYPASS_TRACE='1'),
+                                  withexitstatus=True, timeout=TIMEOUT)
+    assert status == 0
+    assert output.startswith('joe  pw\r\n')
+    assert re.search(r'^ *[\d.]+ +[\d.]+ +call get-credentials\r$', output, re.MULTILINE)
+    assert re.search(r'^ *[\d.]+ +[\d.]+ +daemon: execute\r$', output, re.MULTILINE)
+
+
+# Modules that must not be imported, and the maximum time (in microseconds)
+# importing mypass may take, when getting credentials from a running daemon.
+STARTUP_FORBIDDEN_MODULES = {'argparse', 'argcomplete', 'random', 'configparser',
+                             'subprocess', 'pickle', 'csv', 'mypass.config',
+                             'mypass.formats'}
+STARTUP_IMPORT_TIME_BUDGET = 50000
+
+
+def test_startup_imports():
+    run('mypass add example.com joe pw', [('New passphrase: ', 'masterpw'),
+                                          ('Verify passphrase: ', 'masterpw')])
+
+    output, status = pexpect.runu('{} -X importtime -c "from mypass.cli import CLI; CLI()" '
+                                  'get example.com'.format(sys.executable),
+                                  withexitstatus=True, timeout=TIMEOUT)
+    assert status == 0
+    assert output.endswith('joe  pw\r\n')
+
+    imports = {}
+    for line in output.splitlines():
+        match = re.match(r'import time:\s*\d+ \|\s*(\d+) \|\s*(\S+)$', line)
+        if match:
+            imports[match.group(2)] = int(match.group(1))
+
+    assert not STARTUP_FORBIDDEN_MODULES.intersection(imports)
+    assert imports['mypass.cli'] <= STARTUP_IMPORT_TIME_BUDGET